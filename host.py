@@ -14,7 +14,27 @@ import socket
 import speedtest
 import getpass
 import sqlite3
+import re
+import html
+import codecs
+import signal
+import tempfile
+import gzip
+import csv
+import shutil
+import heapq
+import bisect
+import hashlib
+import itertools
+import fnmatch
+import time
+import threading
+from collections import deque, Counter, OrderedDict
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
+from array import array
 
 BOT_TOKEN = "YOUR_BOT_TOKEN"
 AUTHORIZED_IDS = {ADMINS_ID}
@@ -27,10 +47,66 @@ sudo_attempts = {}
 sudo_passwords = {}
 
 DB_PATH = "bot_admin.db"
+db_conn = None
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bot_db")
 
-def init_db():
+def get_db():
+    """Get the shared database connection (database thread only)"""
+    global db_conn
+    if db_conn is None:
+        db_conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+        db_conn.execute("PRAGMA journal_mode=WAL")
+        db_conn.execute("PRAGMA synchronous=NORMAL")
+        db_conn.execute("PRAGMA busy_timeout=5000")
+    return db_conn
+
+def _db_task(func, args):
+    """Run func(conn, *args) and commit, rolling back on error"""
+    conn = get_db()
+    try:
+        result = func(conn, *args)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+
+async def db_call(func, *args):
+    """Run func(conn, *args) in the database thread without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, _db_task, func, args)
+
+def db_call_sync(func, *args):
+    """Run func(conn, *args) in the database thread and wait for the result"""
+    return db_executor.submit(_db_task, func, args).result()
+
+async def db_fetchone(query, params=()):
+    """Fetch a single row"""
+    return await db_call(lambda conn: conn.execute(query, params).fetchone())
+
+async def db_fetchall(query, params=()):
+    """Fetch all rows"""
+    return await db_call(lambda conn: conn.execute(query, params).fetchall())
+
+async def db_execute(query, params=()):
+    """Execute a write query and return the number of affected rows"""
+    return await db_call(lambda conn: conn.execute(query, params).rowcount)
+
+def close_db():
+    """Close the shared database connection and stop the database thread"""
+    def _close():
+        global db_conn
+        if db_conn is not None:
+            db_conn.close()
+            db_conn = None
+    try:
+        db_executor.submit(_close).result()
+    except RuntimeError:
+        pass
+    db_executor.shutdown(wait=True)
+
+def init_db(conn):
     """Initialize database tables if they don't exist"""
-    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS allowed_commands (
@@ -57,54 +133,333 @@ def init_db():
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bg_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            command TEXT NOT NULL,
+            status TEXT NOT NULL,
+            pid INTEGER,
+            pid_created REAL,
+            returncode INTEGER,
+            output_path TEXT,
+            created_at REAL,
+            finished_at REAL
+        )
+    ''')
+    migrate_db(conn)
+
+def enable_incremental_vacuum(conn):
+    """Switch the database to incremental auto-vacuum, rebuilding it once if needed"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # VACUUM can't run inside the transaction left open by earlier migrations
     conn.commit()
-    conn.close()
+    logging.info("Running one-time VACUUM to enable incremental auto-vacuum, this may take a while...")
+    conn.execute("VACUUM")
+    logging.info("Database switched to incremental auto-vacuum")
 
-init_db()
+# Each entry upgrades the schema by one version, tracked in PRAGMA user_version.
+# An entry is a list of statements or a function called with the connection.
+SCHEMA_MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS idx_bot_logs_timestamp ON bot_logs(timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_bot_logs_user_timestamp ON bot_logs(user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_bot_logs_action_timestamp ON bot_logs(action, timestamp)"
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS log_action_counts (action TEXT PRIMARY KEY, count INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS log_user_counts (user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS log_hourly (hour TEXT NOT NULL, action TEXT NOT NULL, count INTEGER NOT NULL, "
+        "PRIMARY KEY (hour, action)) WITHOUT ROWID",
+        "INSERT OR REPLACE INTO log_action_counts SELECT action, COUNT(*) FROM bot_logs WHERE action IS NOT NULL GROUP BY action",
+        "INSERT OR REPLACE INTO log_user_counts SELECT user_id, COUNT(*) FROM bot_logs WHERE user_id IS NOT NULL GROUP BY user_id",
+        "INSERT OR REPLACE INTO log_hourly SELECT substr(timestamp, 1, 13), action, COUNT(*) FROM bot_logs "
+        "WHERE action IS NOT NULL GROUP BY 1, 2"
+    ],
+    enable_incremental_vacuum
+]
 
-def log_action(user_id, action, details=""):
-    """Log user actions to database"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO bot_logs (user_id, action, details) VALUES (?, ?, ?)",
-            (user_id, action, details)
-        )
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logging.error(f"Logging error: {e}")
+def migrate_db(conn):
+    """Apply pending schema migrations"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        if callable(statements):
+            statements(conn)
+        else:
+            for statement in statements:
+                conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {number}")
+        logging.info(f"Database migrated to schema version {number}")
+
+db_call_sync(init_db)
+
+LOG_BATCH_SIZE = 200
+LOG_FLUSH_INTERVAL = 2.0
+LOG_QUEUE_LIMIT = 10000
+
+loop_primitives = {}
+
+def loop_primitive(name, factory):
+    """Get a shared asyncio lock or semaphore, created on first use inside the running loop
+    
+    Primitives created at import bind to the wrong loop on Python < 3.10.
+    """
+    primitive = loop_primitives.get(name)
+    if primitive is None:
+        primitive = loop_primitives[name] = factory()
+    return primitive
+
+log_queue = deque()
+log_stats = {
+    "flushed": 0,
+    "batches": 0,
+    "errors": 0,
+    "max_depth": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0
+}
 
-def is_authorized(user_id):
+async def log_action(user_id, action, details=""):
+    """Queue a user action for the audit log"""
+    log_queue.append((user_id, action, details, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
+    depth = len(log_queue)
+    if depth > log_stats["max_depth"]:
+        log_stats["max_depth"] = depth
+    # Backpressure: writer fell behind, flush inline before accepting more
+    if depth >= LOG_QUEUE_LIMIT:
+        await flush_logs()
+
+def write_log_batch(conn, batch):
+    """Insert a batch of log rows and update summary counters in one transaction"""
+    conn.executemany(
+        "INSERT INTO bot_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
+        batch
+    )
+    conn.executemany(
+        "INSERT INTO log_action_counts (action, count) VALUES (?, ?) "
+        "ON CONFLICT(action) DO UPDATE SET count = count + excluded.count",
+        Counter(row[1] for row in batch).items()
+    )
+    conn.executemany(
+        "INSERT INTO log_user_counts (user_id, count) VALUES (?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET count = count + excluded.count",
+        Counter(row[0] for row in batch).items()
+    )
+    conn.executemany(
+        "INSERT INTO log_hourly (hour, action, count) VALUES (?, ?, ?) "
+        "ON CONFLICT(hour, action) DO UPDATE SET count = count + excluded.count",
+        ((hour, action, count) for (hour, action), count in Counter((row[3][:13], row[1]) for row in batch).items())
+    )
+
+async def flush_logs():
+    """Write all queued log entries to database in batches"""
+    async with loop_primitive("log_flush", asyncio.Lock):
+        while log_queue:
+            batch = [log_queue.popleft() for _ in range(min(LOG_BATCH_SIZE, len(log_queue)))]
+            started = time.perf_counter()
+            try:
+                await db_call(write_log_batch, batch)
+            except Exception as e:
+                log_stats["errors"] += 1
+                log_queue.extendleft(reversed(batch))
+                logging.error(f"Logging error: {e}")
+                return
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            log_stats["flushed"] += len(batch)
+            log_stats["batches"] += 1
+            log_stats["last_flush_ms"] = elapsed_ms
+            log_stats["max_flush_ms"] = max(log_stats["max_flush_ms"], elapsed_ms)
+
+async def log_writer():
+    """Background task flushing the audit log queue by size or time"""
+    last_flush = time.monotonic()
+    while True:
+        await asyncio.sleep(0.2)
+        if len(log_queue) >= LOG_BATCH_SIZE or (log_queue and time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL):
+            await flush_logs()
+            last_flush = time.monotonic()
+
+AUTH_CACHE_TTL = 300
+
+auth_cache = {"allowed": frozenset(), "blocked": frozenset(), "loaded_at": None}
+auth_stats = {"hits": 0, "reloads": 0}
+
+async def reload_auth_cache():
+    """Reload blocked users from database and rebuild the allowed set"""
+    rows = await db_fetchall("SELECT user_id FROM blocked_users")
+    blocked = frozenset(row[0] for row in rows)
+    auth_cache["blocked"] = blocked
+    auth_cache["allowed"] = frozenset(AUTHORIZED_IDS) - blocked
+    auth_cache["loaded_at"] = time.monotonic()
+    auth_stats["reloads"] += 1
+
+async def is_authorized(user_id):
     """Check if user is authorized and not blocked"""
+    loaded_at = auth_cache["loaded_at"]
+    if loaded_at is None or (AUTH_CACHE_TTL and time.monotonic() - loaded_at > AUTH_CACHE_TTL):
+        try:
+            await reload_auth_cache()
+        except Exception as e:
+            logging.error(f"Authorization check error: {e}")
+            if auth_cache["loaded_at"] is None:
+                return False
+    auth_stats["hits"] += 1
+    return user_id in auth_cache["allowed"]
+
+DANGEROUS_COMMANDS = ["rm -rf /", "dd if=", ":(){:|:&};:", "mkfs", "fdisk", "shutdown"]
+DANGEROUS_PATTERN = re.compile("|".join(re.escape(dangerous) for dangerous in DANGEROUS_COMMANDS))
+
+command_policy = {"exact": {}, "prefixes": {}, "deny_patterns": [], "rules": 0, "loaded": False}
+
+def compile_command_policy(rows):
+    """Compile allowed_commands rows into exact map, prefix trie and deny regex
+    
+    Rule syntax: "prefix:apt " matches by prefix, "re:^curl .*\\| *sh" by regex,
+    text containing * ? or [ is a glob, anything else is an exact command.
+    Exact rules win, then any disabled glob/regex rule denies, then the
+    longest matching prefix decides. Commands are allowed by default, so
+    glob/regex rules only matter when disabled. Globs also match every
+    command chained with ; && | or $(...).
+    """
+    exact = {}
+    prefixes = {}
+    deny = []
+    for command, allowed in rows:
+        allowed = allowed == 1
+        if command.startswith("prefix:"):
+            node = prefixes
+            for char in command[7:]:
+                node = node.setdefault(char, {})
+            node.setdefault(None, allowed)
+        elif command.startswith("re:"):
+            if not allowed:
+                try:
+                    re.compile(command[3:])
+                    deny.append(command[3:])
+                except re.error as e:
+                    logging.error(f"Skipping invalid command regex {command!r}: {e}")
+        elif any(char in command for char in "*?["):
+            if not allowed:
+                # Globs match the whole line or any command chained into it
+                deny.append(r"(?:\A|[;&|`(\n]\s*)" + fnmatch.translate(command))
+        else:
+            exact.setdefault(command, allowed)
+    
+    # One alternation is fastest, but rules with inline flags can't be joined
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM blocked_users WHERE user_id = ?", (user_id,))
-        blocked = cursor.fetchone() is not None
-        conn.close()
-        
-        return user_id in AUTHORIZED_IDS and not blocked
-    except Exception as e:
-        logging.error(f"Authorization check error: {e}")
+        deny_patterns = [re.compile("|".join(f"(?:{pattern})" for pattern in deny))] if deny else []
+    except re.error as e:
+        logging.error(f"Command deny rules can't be combined, checking them one by one: {e}")
+        deny_patterns = [re.compile(pattern) for pattern in deny]
+    return {
+        "exact": exact,
+        "prefixes": prefixes,
+        "deny_patterns": deny_patterns,
+        "rules": len(rows),
+        "loaded": True
+    }
+
+async def reload_command_policy():
+    """Rebuild the command policy from database"""
+    rows = await db_fetchall("SELECT command, allowed FROM allowed_commands ORDER BY id")
+    command_policy.update(compile_command_policy(rows))
+    check_command_policy.cache_clear()
+
+SHELL_CHAIN_PATTERN = re.compile(r"[;&|`\n]|\$\(")
+
+@lru_cache(maxsize=4096)
+def check_command_policy(command):
+    """Decide a command against the compiled policy (cached per command)
+    
+    Commands run through a shell, so deny patterns are checked on every
+    command without an exact rule, and an allowed prefix never covers a
+    command that chains further commands.
+    """
+    allowed = command_policy["exact"].get(command)
+    if allowed is not None:
+        return allowed
+    
+    if any(pattern.search(command) for pattern in command_policy["deny_patterns"]):
         return False
+    
+    chained = SHELL_CHAIN_PATTERN.search(command) is not None
+    node = command_policy["prefixes"]
+    for char in command:
+        node = node.get(char)
+        if node is None:
+            break
+        rule = node.get(None)
+        if rule is False or (rule and not chained):
+            allowed = rule
+    return allowed is not False
 
-def is_command_allowed(command):
-    """Check if command is allowed in database"""
+async def is_command_allowed(command):
+    """Check if command is allowed by the admin command policy"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT allowed FROM allowed_commands WHERE command = ?", (command,))
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result:
-            return result[0] == 1
-        return True
+        if not command_policy["loaded"]:
+            await reload_command_policy()
+        return check_command_policy(command)
     except Exception as e:
+        # Fail closed, a policy that can't be loaded must not allow everything
         logging.error(f"Command check error: {e}")
-        return True
+        return False
+
+def find_dangerous_command(command):
+    """Return the dangerous pattern found in command, if any"""
+    match = DANGEROUS_PATTERN.search(command.lower())
+    return match.group(0) if match else None
+
+def set_command_allowed(conn, command, allowed):
+    """Set the allowed flag of a command, adding it if missing"""
+    cursor = conn.execute("UPDATE allowed_commands SET allowed = ? WHERE command = ?", (allowed, command))
+    if cursor.rowcount == 0:
+        conn.execute(
+            "INSERT INTO allowed_commands (command, allowed) VALUES (?, ?)",
+            (command, allowed)
+        )
+
+def collect_stats(conn):
+    """Collect bot statistics from pre-aggregated summary tables"""
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT COALESCE(SUM(count), 0) FROM log_action_counts")
+    total_logs = cursor.fetchone()[0]
+    
+    cursor.execute("SELECT COUNT(*) FROM log_user_counts")
+    unique_users = cursor.fetchone()[0]
+    
+    cursor.execute("SELECT COUNT(*) FROM allowed_commands")
+    total_commands = cursor.fetchone()[0]
+    
+    cursor.execute("SELECT COUNT(*) FROM blocked_users")
+    blocked_users = cursor.fetchone()[0]
+    
+    cursor.execute("SELECT action, count FROM log_action_counts ORDER BY count DESC LIMIT 5")
+    top_actions = cursor.fetchall()
+    
+    now = datetime.utcnow()
+    cursor.execute(
+        "SELECT hour, SUM(count) FROM log_hourly WHERE hour > ? GROUP BY hour",
+        ((now - timedelta(hours=24)).strftime("%Y-%m-%d %H"),)
+    )
+    by_hour = dict(cursor.fetchall())
+    hourly = [by_hour.get((now - timedelta(hours=i)).strftime("%Y-%m-%d %H"), 0) for i in range(23, -1, -1)]
+    
+    cursor.execute(
+        "SELECT substr(hour, 1, 10), SUM(count) FROM log_hourly WHERE hour > ? GROUP BY 1",
+        ((now - timedelta(days=14)).strftime("%Y-%m-%d 23"),)
+    )
+    by_day = dict(cursor.fetchall())
+    daily = [by_day.get((now - timedelta(days=i)).strftime("%Y-%m-%d"), 0) for i in range(13, -1, -1)]
+    
+    return total_logs, unique_users, total_commands, blocked_users, top_actions, hourly, daily
+
+def clear_logs(conn):
+    """Delete all logs and their summary counters"""
+    for table in ("bot_logs", "log_action_counts", "log_user_counts", "log_hourly"):
+        conn.execute(f"DELETE FROM {table}")
 
 def seconds_to_human(seconds):
     """Convert seconds to human readable format"""
@@ -123,43 +478,1177 @@ def seconds_to_human(seconds):
     result.append(f"{secs}s")
     return " ".join(result)
 
-def get_network_info():
-    """Get network interface statistics"""
+NET_EWMA_ALPHA = 0.3
+
+net_rates = {}
+
+def update_net_rates(timestamp, counters):
+    """Update per-interface rates from a net_io_counters(pernic=True) sample"""
+    alpha = NET_EWMA_ALPHA
+    for name, stats in counters.items():
+        state = net_rates.get(name)
+        if state is None:
+            net_rates[name] = {
+                "time": timestamp, "counters": stats, "ready": False,
+                "rx": 0.0, "tx": 0.0, "rx_pps": 0.0, "tx_pps": 0.0, "errors": 0.0, "drops": 0.0,
+                "rx_avg": 0.0, "tx_avg": 0.0, "rx_peak": 0.0, "tx_peak": 0.0
+            }
+            continue
+        
+        elapsed = timestamp - state["time"]
+        if elapsed <= 0:
+            continue
+        prev = state["counters"]
+        # Counters can reset when an interface is recreated, clamp at zero
+        rx = max(0, stats.bytes_recv - prev.bytes_recv) / elapsed
+        tx = max(0, stats.bytes_sent - prev.bytes_sent) / elapsed
+        state["rx"] = rx
+        state["tx"] = tx
+        state["rx_pps"] = max(0, stats.packets_recv - prev.packets_recv) / elapsed
+        state["tx_pps"] = max(0, stats.packets_sent - prev.packets_sent) / elapsed
+        state["errors"] = max(0, stats.errin + stats.errout - prev.errin - prev.errout) / elapsed
+        state["drops"] = max(0, stats.dropin + stats.dropout - prev.dropin - prev.dropout) / elapsed
+        if state["ready"]:
+            state["rx_avg"] += alpha * (rx - state["rx_avg"])
+            state["tx_avg"] += alpha * (tx - state["tx_avg"])
+        else:
+            state["rx_avg"] = rx
+            state["tx_avg"] = tx
+            state["ready"] = True
+        if rx > state["rx_peak"]:
+            state["rx_peak"] = rx
+        if tx > state["tx_peak"]:
+            state["tx_peak"] = tx
+        state["time"] = timestamp
+        state["counters"] = stats
+    
+    if len(net_rates) != len(counters):
+        for name in net_rates.keys() - counters.keys():
+            del net_rates[name]
+
+NET_TOP_INTERFACES = 8
+
+def net_interface_rank(item):
+    """Sort key putting the busiest interfaces first, then the largest totals"""
+    name, stats = item
+    state = net_rates.get(name)
+    rate = state["rx"] + state["tx"] if state and state["ready"] else 0
+    return (-rate, -(stats.bytes_recv + stats.bytes_sent), name)
+
+def get_network_info(counters=None):
+    """Get throughput and totals of the NET_TOP_INTERFACES busiest interfaces"""
+    if counters is None:
+        counters = psutil.net_io_counters(pernic=True)
+    interfaces = [item for item in counters.items() if item[0] != 'lo']
+    # Hosts with many veth/tap devices would overflow the message limit
+    top = heapq.nsmallest(NET_TOP_INTERFACES, interfaces, key=net_interface_rank)
     info = []
-    for name, stats in psutil.net_io_counters(pernic=True).items():
-        if name != 'lo':
-            info.append(f"<b>{name}</b>:")
-            info.append(f"  📥 {stats.bytes_recv // 1024**2:.1f} MB")
-            info.append(f"  📤 {stats.bytes_sent // 1024**2:.1f} MB")
-            info.append(f"  🔄 Packets: {stats.packets_recv}/{stats.packets_sent}")
+    for name, stats in top:
+        state = net_rates.get(name)
+        info.append(f"<b>{html.escape(name)}</b>:")
+        if state and state["ready"]:
+            info.append(f"  📥 {format_bytes(state['rx'])}/s (avg {format_bytes(state['rx_avg'])}/s, peak {format_bytes(state['rx_peak'])}/s)")
+            info.append(f"  📤 {format_bytes(state['tx'])}/s (avg {format_bytes(state['tx_avg'])}/s, peak {format_bytes(state['tx_peak'])}/s)")
+            info.append(f"  🔄 Packets/s: {state['rx_pps']:.0f}/{state['tx_pps']:.0f}")
+            if state["errors"] or state["drops"]:
+                info.append(f"  ⚠️ Errors/s: {state['errors']:.1f} | Drops/s: {state['drops']:.1f}")
+        info.append(f"  Σ {format_bytes(stats.bytes_recv)} in / {format_bytes(stats.bytes_sent)} out")
+    if len(interfaces) > len(top):
+        info.append(f"<i>…and {len(interfaces) - len(top)} more</i>")
     return "\n".join(info) if info else "No network data"
 
+METRICS_INTERVAL = 5
+
+metrics_snapshot = {}
+
+PROC_PAGE_SIZE = 15
+PROC_FULL_SAMPLE_EVERY = 12
+PROC_SORT_KEYS = {
+    "cpu": ("CPU", "cpu_percent"),
+    "mem": ("Memory", "rss"),
+    "io": ("IO", "io_rate"),
+    "threads": ("Threads", "threads")
+}
+PROC_ROW_FIELDS = ("pid", "ppid", "name", "username", "cpu_percent", "memory_percent", "rss",
+                   "io_rate", "io_read_rate", "io_write_rate", "threads", "fds", "ctx_rate")
+PROC_TOP_K = 10
+PROC_TOP_SHOW = 5
+PROC_TOP_WINDOWS = (0, 5, 15, 60)
+PROC_RANK_METRICS = {
+    "cpu": ("CPU", "cpu_percent", lambda v: f"{v:.1f}%"),
+    "rss": ("Memory", "rss", lambda v: format_bytes(v)),
+    "read": ("IO read", "io_read_rate", lambda v: f"{format_bytes(v)}/s"),
+    "write": ("IO write", "io_write_rate", lambda v: f"{format_bytes(v)}/s"),
+    "fds": ("Open FDs", "fds", lambda v: f"{v:.0f}"),
+    "ctx": ("Context switches", "ctx_rate", lambda v: f"{v:.0f}/s")
+}
+
+process_table = {}
+# Per-sample top-K rankings for "hogs of the last N minutes"
+process_top_history = deque(maxlen=max(PROC_TOP_WINDOWS) * 60 // METRICS_INTERVAL)
+process_table_lock = threading.Lock()
+process_stats = {"refresh_ms": 0.0, "tracked": 0, "added": 0, "removed": 0}
+
+def track_process(pid):
+    """Create a tracker entry for a new PID, None if it already exited"""
+    try:
+        proc = psutil.Process(pid)
+        with proc.oneshot():
+            created = proc.create_time()
+            name = proc.name()
+            ppid = proc.ppid()
+            try:
+                username = proc.username()
+            except (psutil.AccessDenied, KeyError):
+                username = "?"
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
+    return {
+        "proc": proc, "pid": pid, "created": created, "ppid": ppid, "name": name, "username": username,
+        "cpu_total": None, "io": None, "ctx_total": None, "io_allowed": True, "fds_allowed": True,
+        "sampled_at": None, "idle_samples": 0, "cpu_percent": 0.0, "memory_percent": 0.0, "rss": 0,
+        "io_rate": None, "io_read_rate": None, "io_write_rate": None, "threads": 0, "fds": None, "ctx_rate": 0.0
+    }
+
+def process_rate(current, previous, elapsed):
+    """Per-second rate of a counter, None when it is unknown or went backwards"""
+    if current is None or previous is None or elapsed <= 0 or current < previous:
+        return None
+    return (current - previous) / elapsed
+
+def sample_process(entry, now, mem_total):
+    """Update a tracker entry from one oneshot() read, False if the process is gone
+    
+    A PID reused by a new process also counts as gone, detected by its
+    create time, so the caller tracks the new process afresh.
+    
+    Processes that used no CPU since the last sample cannot have changed
+    memory, threads, FDs or IO much, so only their stat file is read and
+    the full read is repeated every PROC_FULL_SAMPLE_EVERY samples.
+    """
+    proc = entry["proc"]
+    try:
+        with proc.oneshot():
+            cpu = proc.cpu_times()
+            # Process.create_time() returns the value cached at creation, read the
+            # stat file again instead; oneshot() already loaded it for cpu_times()
+            if proc._proc.create_time() != entry["created"]:
+                return False
+            cpu_total = cpu.user + cpu.system
+            idle = entry["sampled_at"] is not None and cpu_total == entry["cpu_total"]
+            if idle and entry["idle_samples"] < PROC_FULL_SAMPLE_EVERY:
+                entry.update(cpu_percent=0.0, ctx_rate=0.0, sampled_at=now, idle_samples=entry["idle_samples"] + 1)
+                if entry["io_rate"] is not None:
+                    entry.update(io_rate=0.0, io_read_rate=0.0, io_write_rate=0.0)
+                return True
+            # Parents change when orphans are reparented, stat is already cached
+            entry["ppid"] = proc.ppid()
+            rss = proc.memory_info().rss
+            threads = proc.num_threads()
+            ctx = proc.num_ctx_switches()
+            io = None
+            if entry["io_allowed"]:
+                try:
+                    counters = proc.io_counters()
+                    io = (counters.read_bytes, counters.write_bytes)
+                except (psutil.AccessDenied, AttributeError):
+                    # Don't retry /proc/<pid>/io for processes we can never read
+                    entry["io_allowed"] = False
+            if entry["fds_allowed"]:
+                try:
+                    entry["fds"] = proc.num_fds()
+                except (psutil.AccessDenied, AttributeError):
+                    entry["fds_allowed"] = False
+    except (psutil.NoSuchProcess, psutil.ZombieProcess):
+        return False
+    except psutil.AccessDenied:
+        return True
+    
+    elapsed = now - entry["sampled_at"] if entry["sampled_at"] else 0
+    ctx_total = ctx.voluntary + ctx.involuntary
+    previous_io = entry["io"] or (None, None)
+    read_rate = process_rate(io and io[0], previous_io[0], elapsed)
+    write_rate = process_rate(io and io[1], previous_io[1], elapsed)
+    entry.update(
+        cpu_percent=(process_rate(cpu_total, entry["cpu_total"], elapsed) or 0.0) * 100,
+        ctx_rate=process_rate(ctx_total, entry["ctx_total"], elapsed) or 0.0,
+        io_read_rate=read_rate,
+        io_write_rate=write_rate,
+        io_rate=read_rate + write_rate if read_rate is not None and write_rate is not None else None,
+        cpu_total=cpu_total, ctx_total=ctx_total, io=io, sampled_at=now, idle_samples=0, rss=rss, threads=threads,
+        memory_percent=rss / mem_total * 100 if mem_total else 0.0
+    )
+    return True
+
+def refresh_process_table(mem_total):
+    """Sample all processes, keeping Process objects between calls (blocking)
+    
+    Only PIDs that appeared since the last call get a new Process object,
+    so CPU% and IO rates are deltas over the sampling interval. The same
+    pass keeps a bounded min-heap per ranking metric, O(n log k) overall.
+    Returns the rows and the top PROC_TOP_K per metric, largest first.
+    """
+    with process_table_lock:
+        started = time.perf_counter()
+        now = time.monotonic()
+        pids = psutil.pids()
+        gone = process_table.keys() - set(pids)
+        for pid in gone:
+            del process_table[pid]
+        
+        added = 0
+        rows = []
+        heaps = {metric: [] for metric in PROC_RANK_METRICS}
+        for pid in pids:
+            entry = process_table.get(pid)
+            if entry is None:
+                entry = track_process(pid)
+                if entry is None:
+                    continue
+                process_table[pid] = entry
+                added += 1
+            if not sample_process(entry, now, mem_total):
+                # Exited, or the PID now belongs to a new process
+                del process_table[pid]
+                entry = track_process(pid)
+                if entry is None or not sample_process(entry, now, mem_total):
+                    continue
+                process_table[pid] = entry
+                added += 1
+            row = {field: entry[field] for field in PROC_ROW_FIELDS}
+            rows.append(row)
+            for metric, (_, field, _) in PROC_RANK_METRICS.items():
+                value = row[field]
+                if not value:
+                    continue
+                heap = heaps[metric]
+                item = (value, pid, row["name"])
+                if len(heap) < PROC_TOP_K:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+        
+        top = {metric: sorted(heap, reverse=True) for metric, heap in heaps.items()}
+        process_top_history.append((time.time(), top))
+        process_stats.update(
+            refresh_ms=(time.perf_counter() - started) * 1000,
+            tracked=len(process_table),
+            added=process_stats["added"] + added,
+            removed=process_stats["removed"] + len(gone)
+        )
+        return rows, top
+
+def process_hogs(minutes):
+    """Average the per-sample rankings over the last minutes, returns (hogs, samples)
+    
+    Only the top PROC_TOP_K of each sample are kept, so a process that
+    never made a sample's top list counts as zero for it.
+    """
+    since = time.time() - minutes * 60
+    samples = [top for sampled_at, top in list(process_top_history) if sampled_at >= since]
+    if not samples:
+        return {}, 0
+    hogs = {}
+    for metric in PROC_RANK_METRICS:
+        totals = Counter()
+        for top in samples:
+            for value, pid, name in top[metric]:
+                totals[(pid, name)] += value
+        hogs[metric] = heapq.nlargest(
+            PROC_TOP_SHOW, ((total / len(samples), pid, name) for (pid, name), total in totals.items())
+        )
+    return hogs, len(samples)
+
+def collect_metrics():
+    """Collect host metrics (blocking, run in a worker thread)"""
+    per_cpu = psutil.cpu_percent(interval=None, percpu=True)
+    
+    disks = []
+    for part in psutil.disk_partitions(all=False):
+        try:
+            disks.append((part, psutil.disk_usage(part.mountpoint)))
+        except:
+            continue
+    
+    memory = psutil.virtual_memory()
+    processes, process_top = refresh_process_table(memory.total)
+    
+    return {
+        "time": time.time(),
+        "cpu_percent": sum(per_cpu) / len(per_cpu) if per_cpu else 0.0,
+        "per_cpu": per_cpu,
+        "cpu_freq": psutil.cpu_freq(),
+        "cpu_count": psutil.cpu_count(),
+        "cpu_count_physical": psutil.cpu_count(logical=False),
+        "memory": memory,
+        "swap": psutil.swap_memory(),
+        "load_avg": psutil.getloadavg(),
+        "boot_time": psutil.boot_time(),
+        "disks": disks,
+        "net": psutil.net_io_counters(pernic=True),
+        "processes": processes,
+        "process_top": process_top
+    }
+
+async def refresh_metrics():
+    """Take a new metrics sample without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    metrics_snapshot.update(await loop.run_in_executor(None, collect_metrics))
+    return metrics_snapshot
+
+async def metrics_sampler():
+    """Background task refreshing the shared metrics snapshot"""
+    while True:
+        try:
+            snapshot = await refresh_metrics()
+            update_net_rates(snapshot["time"], snapshot["net"])
+            append_history(snapshot["time"], history_values(snapshot))
+        except Exception as e:
+            logging.error(f"Metrics sampler error: {e}")
+        await asyncio.sleep(METRICS_INTERVAL)
+
+async def get_metrics():
+    """Get the latest metrics snapshot, sampling once if none exists yet"""
+    if not metrics_snapshot:
+        await refresh_metrics()
+    return metrics_snapshot
+
+def metrics_age_text(snapshot):
+    """Describe how old a metrics snapshot is"""
+    age = max(0, int(time.time() - snapshot["time"]))
+    return f"<i>🕒 Data age: {seconds_to_human(age)}</i>"
+
+HISTORY_TIERS = [
+    ("1h", METRICS_INTERVAL, 3600 // METRICS_INTERVAL),
+    ("24h", 60, 1440),
+    ("30d", 900, 2880)
+]
+HISTORY_MAX_SERIES = 64
+HISTORY_TOP_DISKS = 8
+HISTORY_TOP_INTERFACES = 4
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+NAN = float("nan")
+
+history_tiers = [
+    {
+        "name": name,
+        "step": step,
+        "capacity": capacity,
+        "times": array("d", [0.0]) * capacity,
+        "series": {},
+        "updated": {},
+        "acc": {},
+        "pos": 0,
+        "count": 0,
+        "bucket": None
+    }
+    for name, step, capacity in HISTORY_TIERS
+]
+
+def history_memory_bytes():
+    """Upper bound of memory used by history buffers"""
+    return sum(tier["capacity"] * (8 + 4 * HISTORY_MAX_SERIES) for tier in history_tiers)
+
+def format_bytes(value):
+    """Format a byte count with a binary unit"""
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if abs(value) < 1024 or unit == "TB":
+            return f"{value:.1f} {unit}" if unit != "B" else f"{value:.0f} B"
+        value /= 1024
+
+def _flush_history_tier(tier):
+    """Store the averaged pending bucket of a tier in its ring buffer"""
+    pos = tier["pos"]
+    acc = tier["acc"]
+    tier["times"][pos] = tier["bucket"] * tier["step"]
+    for name, data in tier["series"].items():
+        entry = acc.get(name)
+        data[pos] = entry[0] / entry[1] if entry else NAN
+    # A series silent for a whole ring holds only NaN, free its slot
+    updated = tier["updated"]
+    for name in [n for n, bucket in updated.items() if tier["bucket"] - bucket >= tier["capacity"]]:
+        del tier["series"][name], updated[name]
+    tier["pos"] = (pos + 1) % tier["capacity"]
+    tier["count"] = min(tier["count"] + 1, tier["capacity"])
+    tier["acc"] = {}
+
+def append_history(timestamp, values):
+    """Add one sample of named values to every history tier"""
+    for tier in history_tiers:
+        bucket = int(timestamp // tier["step"])
+        if tier["bucket"] is None:
+            tier["bucket"] = bucket
+        elif bucket != tier["bucket"]:
+            _flush_history_tier(tier)
+            tier["bucket"] = bucket
+        
+        series = tier["series"]
+        updated = tier["updated"]
+        acc = tier["acc"]
+        for name, value in values.items():
+            if name not in series:
+                if len(series) >= HISTORY_MAX_SERIES:
+                    # Replace the series that stopped reporting longest ago, never a live one
+                    stale = min(updated, key=updated.get)
+                    if updated[stale] >= bucket:
+                        continue
+                    del series[stale], updated[stale]
+                series[name] = array("f", [NAN]) * tier["capacity"]
+            updated[name] = bucket
+            entry = acc.get(name)
+            if entry is None:
+                acc[name] = [value, 1]
+            else:
+                entry[0] += value
+                entry[1] += 1
+
+def history_values(snapshot):
+    """Extract history series values from a metrics snapshot"""
+    values = {
+        "cpu": snapshot["cpu_percent"],
+        "ram": snapshot["memory"].percent,
+        "swap": snapshot["swap"].percent,
+        "load": snapshot["load_avg"][0]
+    }
+    for part, usage in snapshot["disks"]:
+        values[f"disk:{part.mountpoint}"] = usage.percent
+    
+    for name, state in net_rates.items():
+        if name != "lo" and state["ready"]:
+            values[f"rx:{name}"] = state["rx"]
+            values[f"tx:{name}"] = state["tx"]
+    return values
+
+def read_history(tier, name):
+    """Return a series of a tier ordered from oldest to newest"""
+    data = tier["series"].get(name)
+    if data is None:
+        return []
+    capacity = tier["capacity"]
+    start = tier["pos"] - tier["count"]
+    return [data[(start + i) % capacity] for i in range(tier["count"])]
+
+def sparkline(values, width=24):
+    """Render values as a unicode sparkline averaged down to width chars"""
+    points = []
+    chunk = max(1, -(-len(values) // width))
+    for i in range(0, len(values), chunk):
+        valid = [v for v in values[i:i + chunk] if v == v]
+        points.append(sum(valid) / len(valid) if valid else None)
+    
+    valid = [p for p in points if p is not None]
+    if not valid:
+        return ""
+    low, high = min(valid), max(valid)
+    span = (high - low) or 1
+    return "".join(
+        " " if p is None else SPARK_CHARS[int((p - low) / span * (len(SPARK_CHARS) - 1))]
+        for p in points
+    )
+
+def render_history(tier_name):
+    """Render sparkline charts of a history tier
+    
+    Only the HISTORY_TOP_DISKS fullest disks and HISTORY_TOP_INTERFACES
+    busiest interfaces are drawn, so hosts with many NICs stay within the
+    message limit.
+    """
+    tier = next((t for t in history_tiers if t["name"] == tier_name), history_tiers[0])
+    lines = [f"<b>📈 History ({tier['name']})</b>\n━━━━━━━━━━━━━━━━━━━━━━"]
+    
+    series = {}
+    for name in tier["series"]:
+        values = [v for v in read_history(tier, name) if v == v]
+        if values:
+            series[name] = values
+    disks = sorted((n for n in series if n.startswith("disk:")), key=lambda n: -series[n][-1])
+    traffic = Counter()
+    for name, values in series.items():
+        if name.startswith(("rx:", "tx:")):
+            traffic[name[3:]] += sum(values) / len(values)
+    interfaces = [name for name, _ in traffic.most_common()]
+    shown = [n for n in series if ":" not in n] + disks[:HISTORY_TOP_DISKS]
+    for interface in interfaces[:HISTORY_TOP_INTERFACES]:
+        shown.extend(n for n in (f"rx:{interface}", f"tx:{interface}") if n in series)
+    
+    for name in shown:
+        values = series[name]
+        if name.startswith(("rx:", "tx:")):
+            fmt = lambda v: f"{format_bytes(v)}/s"
+            label = f"{'📥' if name.startswith('rx:') else '📤'} {html.escape(name[3:])}"
+        elif name == "load":
+            fmt = lambda v: f"{v:.2f}"
+            label = "Load"
+        else:
+            fmt = lambda v: f"{v:.1f}%"
+            label = html.escape(name[5:]) if name.startswith("disk:") else name.upper()
+        lines.append(f"<b>{label}</b>: {fmt(values[-1])} (min {fmt(min(values))}, max {fmt(max(values))})")
+        lines.append(f"<code>{sparkline(read_history(tier, name))}</code>")
+    
+    hidden = []
+    if len(disks) > HISTORY_TOP_DISKS:
+        hidden.append(f"{len(disks) - HISTORY_TOP_DISKS} more disks")
+    if len(interfaces) > HISTORY_TOP_INTERFACES:
+        hidden.append(f"{len(interfaces) - HISTORY_TOP_INTERFACES} more interfaces")
+    if hidden:
+        lines.append(f"<i>…and {', '.join(hidden)}</i>")
+    if len(lines) == 1:
+        lines.append("<i>No samples yet</i>")
+    lines.append(f"\n<i>{tier['count']}/{tier['capacity']} points, step {seconds_to_human(tier['step'])}, "
+                 f"buffers {history_memory_bytes() // 1024} KB</i>")
+    return "\n".join(lines)
+
+def history_keyboard():
+    """Create history range selection keyboard"""
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=name, callback_data=f"history_{name}") for name, _, _ in HISTORY_TIERS],
+        [types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")]
+    ])
+
+PING_COUNT = 3
+PING_TIMEOUT = 15
+PING_CONCURRENCY = 8
+PING_MAX_HOSTS = 20
+PING_EDIT_INTERVAL = 1.0
+PING_GROUPS = {
+    "dns": ["8.8.8.8", "1.1.1.1", "9.9.9.9"]
+}
+PING_STATS_PATTERN = re.compile(r"(\d+) packets transmitted, (\d+) (?:packets )?received")
+PING_RTT_PATTERN = re.compile(r"min/avg/max(?:/\w+)? = ([\d.]+)/([\d.]+)/([\d.]+)")
+
+
+def parse_ping_output(host, output):
+    """Parse ping summary lines into packet and RTT statistics"""
+    result = {"host": host, "sent": 0, "received": 0, "loss": 100.0, "min": None, "avg": None, "max": None, "error": None}
+    stats = PING_STATS_PATTERN.search(output)
+    if stats:
+        result["sent"] = int(stats.group(1))
+        result["received"] = int(stats.group(2))
+        if result["sent"]:
+            result["loss"] = 100.0 * (result["sent"] - result["received"]) / result["sent"]
+    rtt = PING_RTT_PATTERN.search(output)
+    if rtt:
+        result["min"], result["avg"], result["max"] = (float(x) for x in rtt.groups())
+    return result
+
 async def ping_host(host="8.8.8.8"):
-    """Ping a host and return result"""
+    """Ping a host and return parsed result"""
+    if host.startswith("-"):
+        return {"host": host, "error": "invalid host"}
+    async with loop_primitive("ping", lambda: asyncio.Semaphore(PING_CONCURRENCY)):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ping", "-c", str(PING_COUNT), "-W", "2", host,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=PING_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                return {"host": host, "error": "timeout"}
+            result = parse_ping_output(host, stdout.decode('utf-8', errors='ignore'))
+            if not result["sent"]:
+                error = stderr.decode('utf-8', errors='ignore').strip().splitlines()
+                result["error"] = error[-1][:100] if error else "Ping error"
+            return result
+        except Exception as e:
+            return {"host": host, "error": str(e)[:100]}
+
+def resolve_ping_targets(args):
+    """Expand @group names and drop duplicates, keeping order"""
+    hosts = []
+    for arg in args:
+        if arg.startswith("@"):
+            hosts.extend(PING_GROUPS.get(arg[1:], []))
+        else:
+            hosts.append(arg)
+    return list(dict.fromkeys(hosts))[:PING_MAX_HOSTS]
+
+def format_ping_result(host, result):
+    """Format one host line of a ping report"""
+    host = html.escape(host)
+    if result is None:
+        return f"⏳ <b>{host}</b>: running..."
+    if result.get("error"):
+        return f"❌ <b>{host}</b>: {html.escape(str(result['error']))}"
+    if not result["received"]:
+        return f"❌ <b>{host}</b>: no reply ({result['loss']:.0f}% loss)"
+    icon = "✅" if result["loss"] == 0 else "⚠️"
+    return (f"{icon} <b>{host}</b>: {result['min']:.1f}/{result['avg']:.1f}/{result['max']:.1f} ms, "
+            f"loss {result['loss']:.0f}%")
+
+def render_ping_results(hosts, results):
+    """Render ping report for all hosts"""
+    lines = [f"<b>🏓 Ping Test ({len(results)}/{len(hosts)})</b>\n━━━━━━━━━━━━━━━━━━━━━━",
+             "<i>min/avg/max RTT</i>"]
+    lines.extend(format_ping_result(host, results.get(host)) for host in hosts)
+    return "\n".join(lines)
+
+async def run_ping_batch(message, hosts, reply_markup=None):
+    """Ping hosts concurrently, editing message as results arrive"""
+    results = {}
+    last_edit = time.monotonic()
+    for future in asyncio.as_completed([ping_host(host) for host in hosts]):
+        result = await future
+        results[result["host"]] = result
+        if len(results) < len(hosts) and time.monotonic() - last_edit >= PING_EDIT_INTERVAL:
+            last_edit = time.monotonic()
+            try:
+                await message.edit_text(render_ping_results(hosts, results))
+            except Exception as e:
+                logging.warning(f"Ping progress edit failed: {e}")
     try:
-        result = await asyncio.create_subprocess_exec(
-            "ping", "-c", "3", host,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+        await message.edit_text(render_ping_results(hosts, results), reply_markup=reply_markup)
+    except Exception as e:
+        logging.error(f"Error showing ping results: {e}")
+
+SPEEDTEST_CACHE_TTL = 600
+SPEEDTEST_SERVER_TTL = 3600
+SPEEDTEST_HISTORY = 10
+
+speedtest_state = {"task": None, "result": None, "server": None, "server_time": 0.0}
+speedtest_history = deque(maxlen=SPEEDTEST_HISTORY)
+
+def run_speed_test():
+    """Run a blocking speed test (worker thread)"""
+    st = speedtest.Speedtest()
+    server = speedtest_state["server"]
+    if server and time.time() - speedtest_state["server_time"] < SPEEDTEST_SERVER_TTL:
+        server = st.get_best_server([server])
+    else:
+        server = st.get_best_server()
+        speedtest_state["server"] = server
+        speedtest_state["server_time"] = time.time()
+    download = st.download() / 1024 / 1024
+    upload = st.upload() / 1024 / 1024
+    return {
+        "time": time.time(),
+        "download": download,
+        "upload": upload,
+        "ping": st.results.ping,
+        "server": f"{server.get('sponsor', '?')} ({server.get('name', '?')})"
+    }
+
+def _speed_test_done(task):
+    """Store the result of a finished speed test job"""
+    speedtest_state["task"] = None
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    speedtest_state["result"] = result
+    speedtest_history.append(result)
+
+def cached_speed_test():
+    """Get the last speed test result if it is still fresh"""
+    result = speedtest_state["result"]
+    if result and time.time() - result["time"] < SPEEDTEST_CACHE_TTL:
+        return result
+    return None
+
+async def speed_test(force=False):
+    """Run internet speed test as a single job shared by all requesters"""
+    if not force:
+        result = cached_speed_test()
+        if result:
+            return result
+    
+    task = speedtest_state["task"]
+    if task is None:
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(loop.run_in_executor(None, run_speed_test))
+        task.add_done_callback(_speed_test_done)
+        speedtest_state["task"] = task
+    return await asyncio.shield(task)
+
+def format_speed_result(result):
+    """Format a speed test result with recent trend"""
+    age = seconds_to_human(max(0, int(time.time() - result["time"])))
+    lines = [
+        f"📥 Download: {result['download']:.1f} Mbps",
+        f"📤 Upload: {result['upload']:.1f} Mbps",
+        f"🏓 Ping: {result['ping']:.0f} ms",
+        f"🛰️ Server: {result['server']}",
+        f"<i>🕒 Measured {age} ago</i>"
+    ]
+    if len(speedtest_history) > 1:
+        lines.append("\n<b>Recent results:</b>")
+        for past in reversed(speedtest_history):
+            stamp = datetime.fromtimestamp(past["time"]).strftime("%m-%d %H:%M")
+            lines.append(f"├─ {stamp}: 📥 {past['download']:.1f} / 📤 {past['upload']:.1f} Mbps")
+    return "\n".join(lines)
+
+UPLOAD_GZIP_THRESHOLD = 1024 * 1024
+
+@contextmanager
+def temp_spool_path(prefix, suffix):
+    """Create a per-request temp file that is always removed afterwards"""
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix)
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        remove_spool_files(path)
+
+def remove_spool_files(path):
+    """Delete a spool file and its compressed copy"""
+    for name in (path, path + ".gz"):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+def gzip_file(path, gz_path):
+    """Compress a file chunk by chunk into gz_path (blocking)"""
+    with open(path, "rb") as src, gzip.open(gz_path, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+async def deliver_file(chat_id, path, filename, caption, compress=True):
+    """Send a file as a document, gzipping it when large unless compress is False
+    
+    The gzip copy lives in a temp spool so nothing is left next to path.
+    Files over one Telegram document go through send_large_file.
+    """
+    size = os.path.getsize(path)
+    if size > DOWNLOAD_PART_SIZE:
+        status = await bot.send_message(chat_id, f"{caption}\n⬇️ <i>Preparing download...</i>")
+        async with download_slots():
+            await send_large_file(chat_id, path, status, filename)
+        return
+    if size <= UPLOAD_GZIP_THRESHOLD or not compress:
+        await bot.send_document(chat_id, FSInputFile(path, filename=filename), caption=caption)
+        return
+    with temp_spool_path("bot_upload_", ".gz") as gz_path:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, gzip_file, path, gz_path)
+        await bot.send_document(
+            chat_id, FSInputFile(gz_path, filename=filename + ".gz"),
+            caption=caption + f" (gzip, {format_bytes(size)} raw)"
         )
-        stdout, stderr = await result.communicate()
-        return stdout.decode('utf-8', errors='ignore')[:1000]
-    except:
-        return "Ping error"
 
-async def speed_test():
-    """Run internet speed test"""
+OUTPUT_MESSAGE_LIMIT = 3500
+OUTPUT_EDIT_INTERVAL = 2.0
+OUTPUT_SPOOL_THRESHOLD = 64 * 1024
+OUTPUT_READ_SIZE = 4096
+SUDO_AUTH_ERRORS = (
+    "sudo: аутентификация не удалась",
+    "sudo: authentication failure",
+    "incorrect password",
+    "Sorry, try again",
+    "no password was provided"
+)
+
+def new_output_spool():
+    """Create an output spool holding small output in memory"""
+    return {"buffer": [], "size": 0, "file": None, "path": None, "tail": "", "stderr_head": "",
+            "returncode": None, "timed_out": False, "timing": ""}
+
+def spool_write(spool, data, text):
+    """Append raw output to spool, moving it to a temp file past the threshold"""
+    spool["size"] += len(data)
+    if spool["file"] is None and spool["size"] > OUTPUT_SPOOL_THRESHOLD:
+        fd, spool["path"] = tempfile.mkstemp(prefix="bot_output_", suffix=".txt")
+        spool["file"] = os.fdopen(fd, "wb")
+        spool["file"].writelines(spool["buffer"])
+        spool["buffer"] = []
+    if spool["file"] is not None:
+        spool["file"].write(data)
+    else:
+        spool["buffer"].append(data)
+    spool["tail"] = (spool["tail"] + text)[-OUTPUT_MESSAGE_LIMIT:]
+
+def spool_text(spool):
+    """Get in-memory spool content as text"""
+    return b"".join(spool["buffer"]).decode("utf-8", errors="ignore")
+
+def spool_cleanup(spool):
+    """Close and delete the spool temp file"""
+    if spool["file"] is not None:
+        spool["file"].close()
+        spool["file"] = None
+    if spool["path"]:
+        remove_spool_files(spool["path"])
+        spool["path"] = None
+
+async def _pump_stream(stream, spool, is_stderr=False):
+    """Copy a process pipe into the spool chunk by chunk"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    while True:
+        data = await stream.read(OUTPUT_READ_SIZE)
+        if not data:
+            break
+        text = decoder.decode(data)
+        spool_write(spool, data, text)
+        if is_stderr and len(spool["stderr_head"]) < 1024:
+            spool["stderr_head"] += text
+
+async def kill_process(process):
+    """Terminate a process and its group, escalating to SIGKILL"""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        if process.returncode is not None:
+            return
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            try:
+                process.send_signal(sig)
+            except ProcessLookupError:
+                return
+        try:
+            await asyncio.wait_for(process.wait(), timeout=5)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+def render_live_output(cmd, spool, status_line):
+    """Render command output tail for a live message"""
+    # Slice after escaping so entities can't push the message past Telegram's limit
+    tail = html.escape(spool["tail"])[-OUTPUT_MESSAGE_LIMIT:]
+    return f"<b>Command:</b> <code>{html.escape(cmd[:200])}</code>\n{status_line}\n<pre>{tail or ' '}</pre>"
+
+async def _live_output_editor(status, cmd, spool, started, reply_markup=None):
+    """Periodically edit status message with the latest output tail"""
+    shown = ""
+    while True:
+        await asyncio.sleep(OUTPUT_EDIT_INTERVAL)
+        if spool["tail"] == shown:
+            continue
+        shown = spool["tail"]
+        elapsed = seconds_to_human(int(time.monotonic() - started))
+        try:
+            await status.edit_text(render_live_output(cmd, spool, f"⏳ <i>Running {elapsed}, {format_bytes(spool['size'])}</i>"),
+                                   reply_markup=reply_markup)
+        except Exception as e:
+            logging.warning(f"Live output edit failed: {e}")
+
+async def stream_process(process, status, cmd, timeout, reply_markup=None):
+    """Stream process output into a spool while live-editing status message"""
+    spool = new_output_spool()
+    started = time.monotonic()
+    editor = asyncio.create_task(_live_output_editor(status, cmd, spool, started, reply_markup))
     try:
-        st = speedtest.Speedtest()
-        st.get_best_server()
-        download = st.download() / 1024 / 1024
-        upload = st.upload() / 1024 / 1024
-        return f"📥 Download: {download:.1f} Mbps\n📤 Upload: {upload:.1f} Mbps"
-    except:
-        return "Speed test error"
+        await asyncio.wait_for(asyncio.gather(
+            _pump_stream(process.stdout, spool),
+            _pump_stream(process.stderr, spool, is_stderr=True),
+            process.wait()
+        ), timeout=timeout)
+        spool["returncode"] = process.returncode
+    except asyncio.TimeoutError:
+        spool["timed_out"] = True
+    except BaseException:
+        spool_cleanup(spool)
+        raise
+    finally:
+        editor.cancel()
+        if process.returncode is None:
+            await kill_process(process)
+        if spool["file"] is not None:
+            spool["file"].flush()
+    return spool
+
+EXEC_MAX_CONCURRENT = 4
+EXEC_MAX_PER_USER = 1
+EXEC_PRIORITY_HIGH = 0
+EXEC_PRIORITY_NORMAL = 1
 
-async def execute_with_sudo(command, password):
-    """Execute command with sudo privileges"""
+exec_queue = []
+exec_jobs = {}
+exec_user_running = {}
+exec_counter = itertools.count(1)
+exec_stats = {"jobs": 0, "cancelled": 0, "running": 0, "wait_total": 0.0, "run_total": 0.0, "max_wait": 0.0}
+
+def _dispatch_exec_queue():
+    """Start queued jobs by priority then FIFO while global and per-user limits allow"""
+    deferred = []
+    while exec_queue and exec_stats["running"] < EXEC_MAX_CONCURRENT:
+        item = heapq.heappop(exec_queue)
+        job = item[2]
+        if job["status"] != "queued":
+            continue
+        if exec_user_running.get(job["user_id"], 0) >= EXEC_MAX_PER_USER:
+            deferred.append(item)
+            continue
+        job["status"] = "running"
+        job["slot"] = True
+        exec_stats["running"] += 1
+        exec_user_running[job["user_id"]] = exec_user_running.get(job["user_id"], 0) + 1
+        job["granted"].set_result(True)
+    for item in deferred:
+        heapq.heappush(exec_queue, item)
+    _notify_queue_positions()
+
+def _notify_queue_positions():
+    """Edit status messages of queued jobs whose queue position changed"""
+    position = 0
+    for _, _, job in sorted(exec_queue):
+        if job["status"] != "queued":
+            continue
+        position += 1
+        if job["position"] != position:
+            job["position"] = position
+            asyncio.ensure_future(_show_queue_position(job))
+
+async def _show_queue_position(job):
+    """Show queue position of a job in its status message"""
+    try:
+        await job["status_message"].edit_text(
+            f"<b>Command:</b> <code>{html.escape(job['cmd'][:200])}</code>\n"
+            f"🕒 <i>Queued, position {job['position']}</i>",
+            reply_markup=exec_cancel_button(job["id"])
+        )
+    except Exception as e:
+        logging.warning(f"Queue position edit failed: {e}")
+
+def exec_cancel_button(job_id):
+    """Create cancel button for a scheduled command"""
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="⛔ Cancel", callback_data=f"exec_cancel_{job_id}")]
+    ])
+
+def format_job_timing(job):
+    """Describe queue wait and run time of a job"""
+    return f"🕒 <i>waited {job['wait']:.1f}s, ran {job['run']:.1f}s</i>"
+
+async def run_scheduled(user_id, cmd, status, start, priority=EXEC_PRIORITY_NORMAL):
+    """Run start(reply_markup) under the execution scheduler
+    
+    Returns (result, job); result is None when the job was cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    job = {
+        "id": next(exec_counter), "user_id": user_id, "cmd": cmd, "status": "queued",
+        "granted": loop.create_future(), "task": None, "status_message": status, "position": None, "slot": False,
+        "queued_at": time.monotonic(), "started_at": None, "wait": 0.0, "run": 0.0
+    }
+    exec_jobs[job["id"]] = job
+    heapq.heappush(exec_queue, (priority, job["id"], job))
+    try:
+        _dispatch_exec_queue()
+        if not await job["granted"] or job["status"] == "cancelled":
+            return None, job
+        job["started_at"] = time.monotonic()
+        job["wait"] = job["started_at"] - job["queued_at"]
+        job["task"] = asyncio.ensure_future(start(exec_cancel_button(job["id"])))
+        try:
+            return await job["task"], job
+        except asyncio.CancelledError:
+            if job["status"] == "cancelled":
+                return None, job
+            job["task"].cancel()
+            raise
+    finally:
+        if job["started_at"] is not None:
+            job["run"] = time.monotonic() - job["started_at"]
+        if job["slot"]:
+            exec_stats["running"] -= 1
+            exec_user_running[user_id] -= 1
+            if not exec_user_running[user_id]:
+                del exec_user_running[user_id]
+        elif job["status"] == "queued":
+            job["status"] = "cancelled"
+        exec_jobs.pop(job["id"], None)
+        exec_stats["jobs"] += 1
+        exec_stats["wait_total"] += job["wait"]
+        exec_stats["run_total"] += job["run"]
+        exec_stats["max_wait"] = max(exec_stats["max_wait"], job["wait"])
+        _dispatch_exec_queue()
+
+def cancel_exec_job(job_id, user_id):
+    """Cancel a queued or running job owned by user"""
+    job = exec_jobs.get(job_id)
+    if job is None or job["user_id"] != user_id or job["status"] == "cancelled":
+        return False
+    previous = job["status"]
+    job["status"] = "cancelled"
+    exec_stats["cancelled"] += 1
+    if previous == "queued":
+        if not job["granted"].done():
+            job["granted"].set_result(False)
+        _notify_queue_positions()
+    elif job["task"] is not None:
+        job["task"].cancel()
+    return True
+
+JOBS_DIR = "bot_jobs"
+BG_JOBS_PER_USER = 3
+BG_JOBS_KEEP = 50
+BG_JOB_POLL_INTERVAL = 5
+BG_JOB_TAIL = 3000
+BG_JOB_ICONS = {"starting": "🕒", "running": "⏳", "done": "✅", "failed": "❌", "cancelled": "⛔", "lost": "❔"}
+
+bg_processes = {}
+bg_cancelled = set()
+
+async def command_block_reason(cmd):
+    """Return why a command is blocked by policy, or None"""
+    if not await is_command_allowed(cmd):
+        return f"🚫 Command <code>{html.escape(cmd[:200])}</code> blocked by admin"
+    dangerous = find_dangerous_command(cmd)
+    if dangerous:
+        return f"🚫 Command blocked for security: {dangerous}"
+    return None
+
+async def start_bg_job(user_id, cmd):
+    """Start a background job writing its output to disk, returns job ID"""
+    running = await db_fetchone(
+        "SELECT COUNT(*) FROM bg_jobs WHERE user_id = ? AND status IN ('starting', 'running')", (user_id,)
+    )
+    if running[0] >= BG_JOBS_PER_USER:
+        raise ValueError(f"Too many running jobs (max {BG_JOBS_PER_USER})")
+    
+    job_id = await db_call(lambda conn: conn.execute(
+        "INSERT INTO bg_jobs (user_id, command, status, created_at) VALUES (?, ?, 'starting', ?)",
+        (user_id, cmd, time.time())
+    ).lastrowid)
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    output_path = os.path.join(JOBS_DIR, f"job_{job_id}.log")
+    try:
+        with open(output_path, "wb") as output:
+            process = await asyncio.create_subprocess_shell(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                start_new_session=True
+            )
+    except Exception:
+        await db_execute("UPDATE bg_jobs SET status = 'failed', finished_at = ? WHERE id = ?", (time.time(), job_id))
+        raise
+    
+    try:
+        pid_created = psutil.Process(process.pid).create_time()
+    except psutil.Error:
+        pid_created = None
+    await db_execute(
+        "UPDATE bg_jobs SET status = 'running', pid = ?, pid_created = ?, output_path = ? WHERE id = ?",
+        (process.pid, pid_created, output_path, job_id)
+    )
+    bg_processes[job_id] = process
+    asyncio.ensure_future(watch_bg_job(job_id, process))
+    await prune_bg_jobs(user_id)
+    return job_id
+
+async def finish_bg_job(job_id, returncode):
+    """Record the final status of a background job"""
+    if job_id in bg_cancelled:
+        bg_cancelled.discard(job_id)
+        status = "cancelled"
+    elif returncode is None:
+        status = "lost"
+    else:
+        status = "done" if returncode == 0 else "failed"
+    await db_execute(
+        "UPDATE bg_jobs SET status = ?, returncode = ?, finished_at = ? WHERE id = ?",
+        (status, returncode, time.time(), job_id)
+    )
+
+async def watch_bg_job(job_id, process):
+    """Wait for a job started by this process to exit"""
+    try:
+        returncode = await process.wait()
+    finally:
+        bg_processes.pop(job_id, None)
+    await finish_bg_job(job_id, returncode)
+
+def decode_wait_status(status):
+    """Convert an os.waitpid status to a returncode like Popen, negative for signals"""
+    # os.waitstatus_to_exitcode only exists on Python 3.9+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def is_same_process(pid, pid_created):
+    """Check that pid still belongs to the process started at pid_created"""
+    try:
+        return not pid_created or abs(psutil.Process(pid).create_time() - pid_created) <= 1
+    except psutil.NoSuchProcess:
+        return False
+
+def poll_detached_pid(pid, pid_created):
+    """Check a job process inherited across restart, returns (finished, returncode)"""
+    # After os.execv the jobs are still our children and can be reaped
+    try:
+        waited_pid, status = os.waitpid(pid, os.WNOHANG)
+        if waited_pid == 0:
+            return False, None
+        return True, decode_wait_status(status)
+    except ChildProcessError:
+        pass
+    if not is_same_process(pid, pid_created):
+        return True, None
+    try:
+        return psutil.Process(pid).status() == psutil.STATUS_ZOMBIE, None
+    except psutil.NoSuchProcess:
+        return True, None
+
+async def watch_detached_bg_job(job_id, pid, pid_created):
+    """Poll a job process that was started before a restart until it exits"""
+    while True:
+        finished, returncode = poll_detached_pid(pid, pid_created)
+        if finished:
+            await finish_bg_job(job_id, returncode)
+            return
+        await asyncio.sleep(BG_JOB_POLL_INTERVAL)
+
+async def recover_bg_jobs():
+    """Resume tracking of jobs left running by a previous bot process"""
+    rows = await db_fetchall("SELECT id, status, pid, pid_created FROM bg_jobs WHERE status IN ('starting', 'running')")
+    for job_id, status, pid, pid_created in rows:
+        if status == "running" and pid:
+            asyncio.ensure_future(watch_detached_bg_job(job_id, pid, pid_created))
+        else:
+            await finish_bg_job(job_id, None)
+
+async def cancel_bg_job(job_id, user_id):
+    """Terminate a running background job owned by user"""
+    row = await db_fetchone("SELECT pid, status, pid_created FROM bg_jobs WHERE id = ? AND user_id = ?", (job_id, user_id))
+    if not row or row[1] != "running":
+        return False
+    process = bg_processes.get(job_id)
+    if process is not None:
+        bg_cancelled.add(job_id)
+        asyncio.ensure_future(kill_process(process))
+    else:
+        # The pid may have been reused since a restart, never signal a stranger
+        if not is_same_process(row[0], row[2]):
+            await finish_bg_job(job_id, None)
+            return False
+        bg_cancelled.add(job_id)
+        try:
+            os.killpg(row[0], signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+    return True
+
+async def prune_bg_jobs(user_id):
+    """Delete the oldest finished jobs of user beyond BG_JOBS_KEEP"""
+    rows = await db_fetchall(
+        "SELECT id, output_path FROM bg_jobs WHERE user_id = ? AND status NOT IN ('starting', 'running') "
+        "ORDER BY id DESC LIMIT -1 OFFSET ?",
+        (user_id, BG_JOBS_KEEP)
+    )
+    for job_id, output_path in rows:
+        await delete_bg_job(job_id, output_path)
+
+async def delete_bg_job(job_id, output_path):
+    """Delete a finished job and its output file"""
+    if output_path:
+        try:
+            os.remove(output_path)
+        except FileNotFoundError:
+            pass
+    await db_execute("DELETE FROM bg_jobs WHERE id = ?", (job_id,))
+
+def read_file_tail(path, size):
+    """Read the last size bytes of a file as text"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - size))
+        return f.read().decode("utf-8", errors="ignore")
+
+async def execute_with_sudo(command, password, status, reply_markup=None):
+    """Execute command with sudo privileges, streaming output into status message"""
     try:
         command_lower = command.lower()
         
@@ -185,38 +1674,36 @@ async def execute_with_sudo(command, password):
         else:
             command_to_run = command
         
-        # Execute with sudo
-        process = await asyncio.create_subprocess_shell(
-            f'echo "{password}" | sudo -S bash -c "{command_to_run}"',
+        # Execute with sudo, password goes through stdin instead of the shell
+        process = await asyncio.create_subprocess_exec(
+            "sudo", "-S", "-p", "", "bash", "-c", command_to_run,
+            stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            shell=True
+            start_new_session=True
         )
+        process.stdin.write(f"{password}\n".encode())
+        await process.stdin.drain()
+        process.stdin.close()
         
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=300)
-        output = stdout.decode('utf-8', errors='ignore')
-        error = stderr.decode('utf-8', errors='ignore')
+        spool = await stream_process(process, status, command, timeout=300, reply_markup=reply_markup)
         
         # Check for authentication errors
-        if "sudo: аутентификация не удалась" in error or "sudo: authentication failure" in error:
-            return None, "❌ Incorrect sudo password"
-        
-        if "[sudo] password for" in error:
+        if any(marker in spool["stderr_head"] for marker in SUDO_AUTH_ERRORS):
+            spool_cleanup(spool)
             return None, "❌ Incorrect sudo password"
         
-        return output, error
-    except asyncio.TimeoutError:
-        return None, "⏱️ Command timeout (300 seconds)"
+        return spool, None
     except Exception as e:
         return None, f"❌ Error: {str(e)}"
 
 @dp.message(Command("start"))
 async def start_handler(message: types.Message):
     """Main menu - start command"""
-    if not is_authorized(message.from_user.id):
+    if not await is_authorized(message.from_user.id):
         return
     
-    log_action(message.from_user.id, "start_command")
+    await log_action(message.from_user.id, "start_command")
     
     if message.from_user.id in user_states:
         user_states.pop(message.from_user.id)
@@ -234,28 +1721,24 @@ async def start_handler(message: types.Message):
 
 @dp.message(Command("ping"))
 async def ping_command(message: types.Message):
-    """Ping a host"""
-    if not is_authorized(message.from_user.id):
+    """Ping hosts or @group concurrently"""
+    if not await is_authorized(message.from_user.id):
         return
     
-    log_action(message.from_user.id, "ping_command")
+    await log_action(message.from_user.id, "ping_command")
     
-    args = message.text.split()
-    host = "8.8.8.8"
-    if len(args) > 1:
-        host = args[1]
+    hosts = resolve_ping_targets(message.text.split()[1:]) or ["8.8.8.8"]
     
-    await message.answer(f"🏓 <b>Ping Test</b>\nHost: {host}\n\n<i>Running...</i>")
-    result = await ping_host(host)
-    await message.answer(f"<b>🏓 Ping Test ({host})</b>\n━━━━━━━━━━━━━━━━━━━━━━\n<pre>{result}</pre>")
+    status = await message.answer(render_ping_results(hosts, {}))
+    await run_ping_batch(status, hosts)
 
 @dp.message(Command("back"))
 async def back_command(message: types.Message):
     """Go back to main menu"""
-    if not is_authorized(message.from_user.id):
+    if not await is_authorized(message.from_user.id):
         return
     
-    log_action(message.from_user.id, "back_command")
+    await log_action(message.from_user.id, "back_command")
     
     user_id = message.from_user.id
     if user_id in user_states:
@@ -263,13 +1746,42 @@ async def back_command(message: types.Message):
     
     await start_handler(message)
 
+@dp.message(Command("history"))
+async def history_command(message: types.Message):
+    """Show metric history charts"""
+    if not await is_authorized(message.from_user.id):
+        return
+    
+    await log_action(message.from_user.id, "history_command")
+    
+    args = message.text.split()
+    tier_name = args[1] if len(args) > 1 else "1h"
+    try:
+        await message.answer(render_history(tier_name), reply_markup=history_keyboard())
+    except Exception as e:
+        logging.error(f"Error showing history: {e}")
+
+@dp.message(Command("top"))
+async def top_command(message: types.Message):
+    """Show top resource consumers"""
+    if not await is_authorized(message.from_user.id):
+        return
+    
+    await log_action(message.from_user.id, "top_command")
+    
+    args = message.text.split()
+    minutes = int(args[1]) if len(args) > 1 and args[1].isdigit() else 0
+    minutes = min(minutes, max(PROC_TOP_WINDOWS))
+    text, keyboard = render_top(await get_metrics(), minutes)
+    await message.answer(text, reply_markup=keyboard)
+
 @dp.message(Command("admin"))
 async def admin_command(message: types.Message):
     """Admin panel"""
-    if not is_authorized(message.from_user.id):
+    if not await is_authorized(message.from_user.id):
         return
     
-    log_action(message.from_user.id, "admin_command")
+    await log_action(message.from_user.id, "admin_command")
     
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
         [types.InlineKeyboardButton(text="📊 Bot Statistics", callback_data="admin_stats")],
@@ -284,29 +1796,12 @@ async def admin_command(message: types.Message):
 @dp.callback_query(F.data == "admin_stats")
 async def admin_stats_handler(callback: types.CallbackQuery):
     """Show bot statistics"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM bot_logs")
-        total_logs = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(DISTINCT user_id) FROM bot_logs")
-        unique_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM allowed_commands")
-        total_commands = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM blocked_users")
-        blocked_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT action, COUNT(*) FROM bot_logs GROUP BY action ORDER BY COUNT(*) DESC LIMIT 5")
-        top_actions = cursor.fetchall()
-        
-        conn.close()
+        await flush_logs()
+        total_logs, unique_users, total_commands, blocked_users, top_actions, hourly, daily = await db_call(collect_stats)
         
         stats_text = f"""
 <b>📊 Bot Statistics</b>
@@ -317,6 +1812,29 @@ async def admin_stats_handler(callback: types.CallbackQuery):
 ├─ Commands in DB: {total_commands}
 └─ Blocked users: {blocked_users}
 
+<b>Log Queue:</b>
+├─ Pending: {len(log_queue)} (max {log_stats['max_depth']})
+├─ Written: {log_stats['flushed']} in {log_stats['batches']} batches
+└─ Flush: {log_stats['last_flush_ms']:.1f} ms (max {log_stats['max_flush_ms']:.1f} ms)
+
+<b>Auth Cache:</b>
+├─ Checks: {auth_stats['hits']}
+└─ Reloads: {auth_stats['reloads']}
+
+<b>Command Queue:</b>
+├─ Running: {exec_stats['running']}/{EXEC_MAX_CONCURRENT}, queued: {len(exec_jobs) - exec_stats['running']}
+├─ Finished: {exec_stats['jobs']} (cancelled {exec_stats['cancelled']})
+└─ Avg wait: {exec_stats['wait_total'] / max(1, exec_stats['jobs']):.1f}s (max {exec_stats['max_wait']:.1f}s), avg run: {exec_stats['run_total'] / max(1, exec_stats['jobs']):.1f}s
+
+<b>Retention:</b>
+├─ Policy: {LOG_RETENTION_DAYS} days, {LOG_RETENTION_MAX_ROWS} rows
+├─ Archived: {retention_stats['archived']} in {retention_stats['runs']} runs
+└─ Last run: {retention_stats['last_run'].strftime('%Y-%m-%d %H:%M') if retention_stats['last_run'] else 'never'} ({retention_stats['last_rows']} rows, {retention_stats['last_seconds']:.1f}s)
+
+<b>Activity:</b>
+├─ Last 24h: {sum(hourly)} <code>{sparkline(hourly)}</code>
+└─ Last 14d: {sum(daily)} <code>{sparkline(daily)}</code>
+
 <b>Top 5 Actions:</b>
 """
         for action, count in top_actions:
@@ -336,7 +1854,7 @@ async def admin_stats_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_users")
 async def admin_users_handler(callback: types.CallbackQuery):
     """User management menu"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
@@ -354,15 +1872,11 @@ async def admin_users_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_view_blocked")
 async def admin_view_blocked_handler(callback: types.CallbackQuery):
     """View blocked users"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, reason, blocked_at FROM blocked_users ORDER BY blocked_at DESC")
-        blocked_users = cursor.fetchall()
-        conn.close()
+        blocked_users = await db_fetchall("SELECT user_id, reason, blocked_at FROM blocked_users ORDER BY blocked_at DESC")
         
         if not blocked_users:
             text = "📭 <b>No blocked users</b>"
@@ -386,7 +1900,7 @@ async def admin_view_blocked_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_block_user")
 async def admin_block_user_handler(callback: types.CallbackQuery):
     """Block a user"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
@@ -409,7 +1923,7 @@ async def admin_block_user_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_unblock_user")
 async def admin_unblock_user_handler(callback: types.CallbackQuery):
     """Unblock a user"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
@@ -431,15 +1945,11 @@ async def admin_unblock_user_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_commands")
 async def admin_commands_handler(callback: types.CallbackQuery):
     """Command management menu"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT command, allowed FROM allowed_commands ORDER BY command")
-        commands = cursor.fetchall()
-        conn.close()
+        commands = await db_fetchall("SELECT command, allowed FROM allowed_commands ORDER BY command")
         
         if not commands:
             text = "📭 <b>No commands in database</b>"
@@ -447,7 +1957,7 @@ async def admin_commands_handler(callback: types.CallbackQuery):
             text = "<b>⚡ Command Management:</b>\n━━━━━━━━━━━━━━━━━━━━━━\n"
             for command, allowed in commands:
                 status = "✅" if allowed == 1 else "❌"
-                text += f"{status} <code>{command}</code>\n"
+                text += f"{status} <code>{html.escape(command)}</code>\n"
         
         keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(text="➕ Add Command", callback_data="admin_add_command")],
@@ -464,14 +1974,18 @@ async def admin_commands_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_add_command")
 async def admin_add_command_handler(callback: types.CallbackQuery):
     """Add a command to database"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
         await callback.message.edit_text(
             "➕ <b>Add Command</b>\n\n"
             "Enter command to add to database:\n"
-            "<i>Example: rm -rf / or sudo reboot</i>\n\n"
+            "<i>Example: rm -rf / or sudo reboot</i>\n"
+            "<i>Patterns: prefix:apt , rm *.log, re:^curl .*\\| *sh</i>\n"
+            "<i>Commands are allowed unless a rule denies them: add a pattern, then "
+            "🚫 Disable it to block matching commands. Disabled patterns apply to the "
+            "whole command line, prefixes never allow chained commands (; &amp;&amp; | `).</i>\n\n"
             "Or press ❌ Cancel to return"
         )
         user_states[callback.from_user.id] = {"mode": "wait_add_command"}
@@ -487,7 +2001,7 @@ async def admin_add_command_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_disable_command")
 async def admin_disable_command_handler(callback: types.CallbackQuery):
     """Disable a command"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
@@ -509,7 +2023,7 @@ async def admin_disable_command_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_enable_command")
 async def admin_enable_command_handler(callback: types.CallbackQuery):
     """Enable a command"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
@@ -531,7 +2045,7 @@ async def admin_enable_command_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_remove_command")
 async def admin_remove_command_handler(callback: types.CallbackQuery):
     """Remove a command from database"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
@@ -550,76 +2064,284 @@ async def admin_remove_command_handler(callback: types.CallbackQuery):
         logging.error(f"Error in admin_remove_command_handler: {e}")
         await callback.answer(f"❌ Error: {str(e)}")
 
+LOG_PAGE_SIZE = 20
+
+log_browser_filters = {}
+
+async def fetch_log_page(filters, direction=None, cursor_id=None):
+    """Fetch a page of logs newest first using keyset pagination on (timestamp, id)"""
+    clauses, params = log_filter_sql(filters)
+    order = "DESC"
+    if direction == "next":
+        clauses.append("(timestamp, id) < ((SELECT timestamp FROM bot_logs WHERE id = ?), ?)")
+        params += [cursor_id, cursor_id]
+    elif direction == "prev":
+        clauses.append("(timestamp, id) > ((SELECT timestamp FROM bot_logs WHERE id = ?), ?)")
+        params += [cursor_id, cursor_id]
+        order = "ASC"
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = await db_fetchall(
+        f"SELECT id, user_id, action, details, timestamp FROM bot_logs {where} "
+        f"ORDER BY timestamp {order}, id {order} LIMIT ?",
+        (*params, LOG_PAGE_SIZE + 1)
+    )
+    has_more = len(rows) > LOG_PAGE_SIZE
+    rows = rows[:LOG_PAGE_SIZE]
+    if direction == "prev":
+        rows.reverse()
+    return rows, has_more
+
+def describe_log_filters(filters):
+    """Describe active log filters"""
+    parts = []
+    if "from" in filters:
+        parts.append(f"from {filters['from']:%Y-%m-%d}")
+    if "to" in filters:
+        parts.append(f"to {filters['to']:%Y-%m-%d}")
+    if "user" in filters:
+        parts.append(f"user {filters['user']}")
+    if "action" in filters:
+        parts.append(f"action {html.escape(filters['action'])}")
+    return ", ".join(parts)
+
+async def show_log_page(callback, direction=None, cursor_id=None):
+    """Render a page of the log browser"""
+    filters = log_browser_filters.get(callback.from_user.id, {})
+    started = time.perf_counter()
+    logs, has_more = await fetch_log_page(filters, direction, cursor_id)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    
+    if not logs:
+        text = "📭 <b>No logs</b>"
+    else:
+        text = f"<b>📝 Logs ({len(logs)} per page):</b>\n━━━━━━━━━━━━━━━━━━━━━━\n"
+        for _, user_id, action, details, timestamp in logs:
+            text += f"├─ ID: {user_id}\n"
+            text += f"│  Action: {html.escape(action or '')}\n"
+            if details:
+                text += f"│  Details: {html.escape(details[:50])}...\n"
+            text += f"└─ Time: {timestamp}\n\n"
+    if filters:
+        text += f"🔎 <i>Filter: {describe_log_filters(filters)}</i>\n"
+    text += f"<i>⚡ {elapsed_ms:.1f} ms</i>"
+    
+    # Newer rows exist when we paged forward, or paged back and more remain
+    has_newer = direction == "next" or (direction == "prev" and has_more)
+    has_older = direction == "prev" or has_more
+    nav = []
+    if logs and has_newer:
+        nav.append(types.InlineKeyboardButton(text="⬅️ Newer", callback_data=f"admin_logs_prev_{logs[0][0]}"))
+    if logs and has_older:
+        nav.append(types.InlineKeyboardButton(text="Older ➡️", callback_data=f"admin_logs_next_{logs[-1][0]}"))
+    
+    keyboard_buttons = [nav] if nav else []
+    keyboard_buttons.append([
+        types.InlineKeyboardButton(text="⏮️ Newest", callback_data="admin_logs"),
+        types.InlineKeyboardButton(text="🔎 Filter", callback_data="admin_logs_filter")
+    ])
+    if filters:
+        keyboard_buttons.append([types.InlineKeyboardButton(text="✖️ Clear Filter", callback_data="admin_logs_clear")])
+    keyboard_buttons.extend([
+        [types.InlineKeyboardButton(text="📥 Download All Logs", callback_data="admin_download_logs")],
+        [types.InlineKeyboardButton(text="🗄️ Compact Now", callback_data="admin_logs_compact")],
+        [types.InlineKeyboardButton(text="🗑️ Clear Logs", callback_data="admin_clear_logs")],
+        [types.InlineKeyboardButton(text="🔙 Back", callback_data="admin_menu")]
+    ])
+    await callback.message.edit_text(text, reply_markup=types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons))
+
 @dp.callback_query(F.data == "admin_logs")
 async def admin_logs_handler(callback: types.CallbackQuery):
     """View bot logs"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id, action, details, timestamp 
-            FROM bot_logs 
-            ORDER BY timestamp DESC 
-            LIMIT 20
-        """)
-        logs = cursor.fetchall()
-        conn.close()
-        
-        if not logs:
-            text = "📭 <b>No logs</b>"
-        else:
-            text = "<b>📝 Last 20 logs:</b>\n━━━━━━━━━━━━━━━━━━━━━━\n"
-            for user_id, action, details, timestamp in logs:
-                text += f"├─ ID: {user_id}\n"
-                text += f"│  Action: {action}\n"
-                if details:
-                    text += f"│  Details: {details[:50]}...\n"
-                text += f"└─ Time: {timestamp}\n\n"
-        
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="📥 Download All Logs", callback_data="admin_download_logs")],
-            [types.InlineKeyboardButton(text="🗑️ Clear Logs", callback_data="admin_clear_logs")],
-            [types.InlineKeyboardButton(text="🔙 Back", callback_data="admin_menu")]
-        ])
-        await callback.message.edit_text(text, reply_markup=keyboard)
+        await flush_logs()
+        await show_log_page(callback)
     except Exception as e:
         logging.error(f"Error in admin_logs_handler: {e}")
         await callback.message.edit_text(f"❌ Error: {str(e)}", reply_markup=back_to_admin_button())
 
+@dp.callback_query(F.data.startswith("admin_logs_"))
+async def admin_logs_page_handler(callback: types.CallbackQuery):
+    """Page, filter or unfilter the log browser"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    action = callback.data[11:]
+    try:
+        if action == "filter":
+            await callback.message.edit_text(
+                "🔎 <b>Filter Logs</b>\n\n"
+                "Enter filters as key/value pairs:\n"
+                "<i>Example: user 123456789 action execute_command from 2024-01-01 to 2024-01-31</i>",
+                reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+                    [types.InlineKeyboardButton(text="❌ Cancel", callback_data="admin_logs")]
+                ])
+            )
+            user_states[callback.from_user.id] = {"mode": "wait_logs_filter"}
+        elif action == "clear":
+            log_browser_filters.pop(callback.from_user.id, None)
+            await show_log_page(callback)
+        elif action == "compact":
+            await callback.answer("🗄️ Compacting logs...")
+            await flush_logs()
+            rows = await compact_logs()
+            await callback.message.edit_text(
+                f"🗄️ <b>Logs compacted</b>\n"
+                f"Archived {rows} rows older than {LOG_RETENTION_DAYS} days or beyond {LOG_RETENTION_MAX_ROWS} rows"
+                + (f"\nSegment: <code>{retention_stats['last_segment']}</code>" if rows else ""),
+                reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+                    [types.InlineKeyboardButton(text="🔙 Back", callback_data="admin_logs")]
+                ])
+            )
+        else:
+            direction, _, cursor_id = action.partition("_")
+            await show_log_page(callback, direction, int(cursor_id))
+    except Exception as e:
+        logging.error(f"Error in admin_logs_page_handler: {e}")
+        await callback.message.edit_text(f"❌ Error: {str(e)}", reply_markup=back_to_admin_button())
+
+LOG_EXPORT_CHUNK = 5000
+LOG_EXPORT_COLUMNS = ("id", "user_id", "action", "details", "timestamp")
+
+def parse_log_filters(text):
+    """Parse "from DATE to DATE user ID action NAME format csv|jsonl" filters"""
+    tokens = text.split()
+    if len(tokens) % 2:
+        raise ValueError("filters must be key/value pairs")
+    filters = {}
+    for key, value in zip(tokens[::2], tokens[1::2]):
+        key = key.lower()
+        if key in ("from", "to"):
+            filters[key] = datetime.strptime(value, "%Y-%m-%d")
+        elif key == "user":
+            filters["user"] = int(value)
+        elif key == "action":
+            filters["action"] = value
+        elif key == "format" and value.lower() in ("csv", "jsonl"):
+            filters["format"] = value.lower()
+        else:
+            raise ValueError(f"unknown filter: {key} {value}")
+    return filters
+
+def log_filter_sql(filters):
+    """Build WHERE clauses and params for log filters"""
+    clauses = []
+    params = []
+    if "from" in filters:
+        clauses.append("timestamp >= ?")
+        params.append(filters["from"].strftime("%Y-%m-%d %H:%M:%S"))
+    if "to" in filters:
+        clauses.append("timestamp < ?")
+        params.append((filters["to"] + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S"))
+    if "user" in filters:
+        clauses.append("user_id = ?")
+        params.append(filters["user"])
+    if "action" in filters:
+        clauses.append("action = ?")
+        params.append(filters["action"])
+    return clauses, params
+
+def write_log_chunk(out, writer, chunk):
+    """Write a chunk of log rows as CSV or JSON Lines (blocking)"""
+    if writer is not None:
+        writer.writerows(chunk)
+    else:
+        out.writelines(json.dumps(dict(zip(LOG_EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n" for row in chunk)
+
+async def export_logs(path, fmt, filters):
+    """Stream matching logs into a gzip file chunk by chunk, returns (rows, seconds)
+    
+    Chunks are read by keyset pagination on id, so other database work
+    runs between chunks and memory stays bounded by LOG_EXPORT_CHUNK.
+    """
+    clauses, params = log_filter_sql(filters)
+    query = (f"SELECT {', '.join(LOG_EXPORT_COLUMNS)} FROM bot_logs "
+             f"WHERE {' AND '.join(['id > ?'] + clauses)} ORDER BY id LIMIT ?")
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    rows = 0
+    last_id = 0
+    out = await loop.run_in_executor(None, lambda: gzip.open(path, "wt", encoding="utf-8", newline=""))
+    try:
+        writer = csv.writer(out) if fmt == "csv" else None
+        if writer is not None:
+            writer.writerow(LOG_EXPORT_COLUMNS)
+        while True:
+            chunk = await db_fetchall(query, (last_id, *params, LOG_EXPORT_CHUNK))
+            if not chunk:
+                break
+            await loop.run_in_executor(None, write_log_chunk, out, writer, chunk)
+            rows += len(chunk)
+            last_id = chunk[-1][0]
+    finally:
+        await loop.run_in_executor(None, out.close)
+    return rows, time.perf_counter() - started
+
+async def send_log_export(chat_id, fmt, filters):
+    """Export logs to a per-request file and send it to chat_id"""
+    await flush_logs()
+    with temp_spool_path("bot_logs_", f".{fmt}.gz") as path:
+        rows, elapsed = await export_logs(path, fmt, filters)
+        rate = rows / elapsed if elapsed > 0 else rows
+        logging.info(f"Exported {rows} log rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+        caption = f"📝 Bot logs: {rows} rows, {elapsed:.1f}s ({rate:.0f} rows/s)"
+        # Already gzipped, large exports are split into parts by deliver_file
+        await deliver_file(chat_id, path, f"bot_logs.{fmt}.gz", caption, compress=False)
+
 @dp.callback_query(F.data == "admin_download_logs")
 async def admin_download_logs_handler(callback: types.CallbackQuery):
-    """Download all logs as file"""
-    if not is_authorized(callback.from_user.id):
+    """Log export options"""
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM bot_logs ORDER BY timestamp DESC")
-        logs = cursor.fetchall()
-        conn.close()
-        
-        log_file = "/tmp/bot_logs.txt"
-        with open(log_file, "w", encoding="utf-8") as f:
-            f.write("Bot logs:\n")
-            f.write("="*50 + "\n")
-            for log in logs:
-                f.write(f"{log}\n")
-        
-        await bot.send_document(callback.from_user.id, FSInputFile(log_file), caption="📝 Bot logs")
-        os.remove(log_file)
-        await callback.answer("✅ Logs sent")
+        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text="📄 CSV", callback_data="admin_export_csv"),
+             types.InlineKeyboardButton(text="📄 JSON Lines", callback_data="admin_export_jsonl")],
+            [types.InlineKeyboardButton(text="🔎 Filtered Export", callback_data="admin_export_filter")],
+            [types.InlineKeyboardButton(text="🔙 Back", callback_data="admin_logs")]
+        ])
+        await callback.message.edit_text(
+            "📥 <b>Export Logs</b>\nChoose format to export all logs (gzip-compressed):",
+            reply_markup=keyboard
+        )
     except Exception as e:
         logging.error(f"Error in admin_download_logs_handler: {e}")
         await callback.answer(f"❌ Error: {str(e)}")
 
+@dp.callback_query(F.data.startswith("admin_export_"))
+async def admin_export_handler(callback: types.CallbackQuery):
+    """Export logs in the chosen format"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    fmt = callback.data[13:]
+    if fmt == "filter":
+        await callback.message.edit_text(
+            "🔎 <b>Filtered Export</b>\n\n"
+            "Enter filters as key/value pairs:\n"
+            "<i>Example: from 2024-01-01 to 2024-01-31 user 123456789 action execute_command format jsonl</i>\n\n"
+            "All keys are optional, format defaults to csv.",
+            reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text="❌ Cancel", callback_data="admin_download_logs")]
+            ])
+        )
+        user_states[callback.from_user.id] = {"mode": "wait_export_filter"}
+        return
+    
+    try:
+        await callback.answer("⏳ Exporting logs...")
+        await send_log_export(callback.from_user.id, fmt, {})
+    except Exception as e:
+        logging.error(f"Error in admin_export_handler: {e}")
+        await bot.send_message(callback.from_user.id, f"❌ Error: {str(e)}")
+
 @dp.callback_query(F.data == "admin_clear_logs")
 async def admin_clear_logs_handler(callback: types.CallbackQuery):
     """Clear all logs confirmation"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
@@ -635,25 +2357,131 @@ async def admin_clear_logs_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_confirm_clear_logs")
 async def admin_confirm_clear_logs_handler(callback: types.CallbackQuery):
     """Clear all logs"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM bot_logs")
-        conn.commit()
-        conn.close()
+        await flush_logs()
+        await db_call(clear_logs)
+        await vacuum_db()
         
         await callback.message.edit_text("✅ <b>Logs cleared</b>", reply_markup=back_to_admin_button())
     except Exception as e:
         logging.error(f"Error in admin_confirm_clear_logs_handler: {e}")
         await callback.message.edit_text(f"❌ Error: {str(e)}", reply_markup=back_to_admin_button())
 
+LOG_RETENTION_DAYS = 30
+LOG_RETENTION_MAX_ROWS = 200000
+LOG_RETENTION_INTERVAL = 3600
+LOG_RETENTION_BATCH = 1000
+LOG_RETENTION_PAUSE = 0.05
+LOG_ARCHIVE_DIR = "bot_logs_archive"
+VACUUM_STEP_PAGES = 200
+
+retention_stats = {"runs": 0, "archived": 0, "last_run": None, "last_rows": 0, "last_seconds": 0.0, "last_segment": None}
+
+def log_retention_boundary(conn, cutoff, max_rows):
+    """Return the highest log id that falls outside the age or row-count limit"""
+    by_age = conn.execute("SELECT MAX(id) FROM bot_logs WHERE timestamp < ?", (cutoff,)).fetchone()[0] or 0
+    by_count = conn.execute(
+        "SELECT id FROM bot_logs ORDER BY id DESC LIMIT 1 OFFSET ?", (max_rows,)
+    ).fetchone()
+    return max(by_age, by_count[0] if by_count else 0)
+
+def delete_log_batch(conn, rows):
+    """Delete archived rows and subtract them from the summary counters"""
+    conn.execute("DELETE FROM bot_logs WHERE id BETWEEN ? AND ?", (rows[0][0], rows[-1][0]))
+    conn.executemany(
+        "UPDATE log_action_counts SET count = count - ? WHERE action = ?",
+        ((count, action) for action, count in Counter(row[2] for row in rows).items())
+    )
+    conn.executemany(
+        "UPDATE log_user_counts SET count = count - ? WHERE user_id = ?",
+        ((count, user_id) for user_id, count in Counter(row[1] for row in rows).items())
+    )
+    conn.executemany(
+        "UPDATE log_hourly SET count = count - ? WHERE hour = ? AND action = ?",
+        ((count, hour, action) for (hour, action), count in Counter((row[4][:13], row[2]) for row in rows).items())
+    )
+    for table in ("log_action_counts", "log_user_counts", "log_hourly"):
+        conn.execute(f"DELETE FROM {table} WHERE count <= 0")
+
+def vacuum_step(conn, pages):
+    """Release up to pages free pages, returns the pages still free"""
+    # executescript steps the pragma to completion, execute() stops after one page
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+async def vacuum_db():
+    """Return free pages to the filesystem in small steps, then checkpoint the WAL"""
+    while await db_call(vacuum_step, VACUUM_STEP_PAGES):
+        await asyncio.sleep(LOG_RETENTION_PAUSE)
+    await db_fetchall("PRAGMA wal_checkpoint(PASSIVE)")
+
+async def compact_logs():
+    """Archive logs beyond the retention limits to a gzip segment and delete them
+    
+    Rows are moved in LOG_RETENTION_BATCH sized transactions by ascending id,
+    pausing between batches so the log writer never waits long for the lock.
+    Ids grow with time, so everything up to the boundary id is expired.
+    """
+    async with loop_primitive("retention", asyncio.Lock):
+        started = time.perf_counter()
+        cutoff = (datetime.utcnow() - timedelta(days=LOG_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        boundary = await db_call(log_retention_boundary, cutoff, LOG_RETENTION_MAX_ROWS)
+        if not boundary:
+            return 0
+        
+        loop = asyncio.get_running_loop()
+        os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+        path = os.path.join(LOG_ARCHIVE_DIR, f"bot_logs_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.jsonl.gz")
+        query = f"SELECT {', '.join(LOG_EXPORT_COLUMNS)} FROM bot_logs WHERE id <= ? ORDER BY id LIMIT ?"
+        rows = 0
+        out = await loop.run_in_executor(None, lambda: gzip.open(path + ".part", "wt", encoding="utf-8"))
+        try:
+            while True:
+                chunk = await db_fetchall(query, (boundary, LOG_RETENTION_BATCH))
+                if not chunk:
+                    break
+                # Write before deleting, a crash can only duplicate rows in the archive
+                await loop.run_in_executor(None, write_log_chunk, out, None, chunk)
+                await loop.run_in_executor(None, out.flush)
+                await db_call(delete_log_batch, chunk)
+                rows += len(chunk)
+                await asyncio.sleep(LOG_RETENTION_PAUSE)
+        finally:
+            await loop.run_in_executor(None, out.close)
+            if rows:
+                os.replace(path + ".part", path)
+            else:
+                os.remove(path + ".part")
+        
+        await vacuum_db()
+        elapsed = time.perf_counter() - started
+        retention_stats.update(
+            runs=retention_stats["runs"] + 1,
+            archived=retention_stats["archived"] + rows,
+            last_run=datetime.now(),
+            last_rows=rows,
+            last_seconds=elapsed,
+            last_segment=os.path.basename(path)
+        )
+        logging.info(f"Archived {rows} log rows to {path} in {elapsed:.2f}s")
+        return rows
+
+async def log_retention():
+    """Background task applying the log retention policy"""
+    while True:
+        try:
+            await compact_logs()
+        except Exception as e:
+            logging.error(f"Log retention failed: {e}")
+        await asyncio.sleep(LOG_RETENTION_INTERVAL)
+
 @dp.callback_query(F.data == "admin_restart")
 async def admin_restart_handler(callback: types.CallbackQuery):
     """Restart bot confirmation"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
@@ -669,12 +2497,14 @@ async def admin_restart_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_confirm_restart")
 async def admin_confirm_restart_handler(callback: types.CallbackQuery):
     """Restart bot"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     try:
         await callback.message.edit_text("🔄 <b>Restarting bot...</b>\nStopping in 3 seconds.")
         await asyncio.sleep(3)
+        await flush_logs()
+        close_db()
         import sys
         os.execv(sys.executable, [sys.executable] + sys.argv)
     except Exception as e:
@@ -684,23 +2514,25 @@ async def admin_confirm_restart_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "sysinfo")
 async def sysinfo_handler(callback: types.CallbackQuery):
     """Show system information"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
-    cpu_percent = psutil.cpu_percent(interval=1)
-    cpu_freq = psutil.cpu_freq()
-    memory = psutil.virtual_memory()
-    swap = psutil.swap_memory()
-    boot_time = psutil.boot_time()
-    uptime = datetime.now() - datetime.fromtimestamp(boot_time)
+    snapshot = await get_metrics()
+    cpu_freq = snapshot["cpu_freq"]
+    memory = snapshot["memory"]
+    swap = snapshot["swap"]
+    uptime = datetime.now() - datetime.fromtimestamp(snapshot["boot_time"])
+    freq_text = f"{cpu_freq.current:.0f} MHz" if cpu_freq else "Unavailable"
+    per_cpu_text = " ".join(f"{x:.0f}" for x in snapshot["per_cpu"][:32])
     
     info = f"""
 <b>🖥️ System Information</b>
 ━━━━━━━━━━━━━━━━━━━━━━
 <b>CPU:</b>
-├─ Load: {cpu_percent}%
-├─ Frequency: {cpu_freq.current:.0f} MHz
-└─ Cores: {psutil.cpu_count()} ({psutil.cpu_count(logical=False)} physical)
+├─ Load: {snapshot['cpu_percent']:.1f}%
+├─ Per core: {per_cpu_text}
+├─ Frequency: {freq_text}
+└─ Cores: {snapshot['cpu_count']} ({snapshot['cpu_count_physical']} physical)
 
 <b>Memory:</b>
 ├─ RAM: {memory.percent}% ({memory.used // 1024**2} MB / {memory.total // 1024**2} MB)
@@ -708,22 +2540,35 @@ async def sysinfo_handler(callback: types.CallbackQuery):
 
 <b>System:</b>
 ├─ Uptime: {seconds_to_human(int(uptime.total_seconds()))}
-├─ Load average: {', '.join([f'{x:.2f}' for x in psutil.getloadavg()])}
+├─ Load average: {', '.join([f'{x:.2f}' for x in snapshot['load_avg']])}
 └─ Platform: {platform.system()} {platform.release()}
+
+{metrics_age_text(snapshot)}
 """
     await callback.message.edit_text(info, reply_markup=back_to_main_button())
 
+@dp.callback_query(F.data.startswith("history_"))
+async def history_handler(callback: types.CallbackQuery):
+    """Switch metric history range"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    try:
+        await callback.message.edit_text(render_history(callback.data[8:]), reply_markup=history_keyboard())
+    except Exception as e:
+        logging.error(f"Error showing history: {e}")
+
 @dp.callback_query(F.data == "diskinfo")
 async def diskinfo_handler(callback: types.CallbackQuery):
     """Show disk information"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
+    snapshot = await get_metrics()
     disks_info = ["<b>💾 Disk & Memory</b>\n━━━━━━━━━━━━━━━━━━━━━━"]
     
-    for part in psutil.disk_partitions(all=False):
+    for part, usage in snapshot["disks"]:
         try:
-            usage = psutil.disk_usage(part.mountpoint)
             used_gb = usage.used // 1024**3
             total_gb = usage.total // 1024**3
             
@@ -739,12 +2584,19 @@ async def diskinfo_handler(callback: types.CallbackQuery):
         except:
             continue
     
-    await callback.message.edit_text("\n".join(disks_info), reply_markup=back_to_main_button())
+    disks_info.append(metrics_age_text(snapshot))
+    user_id = callback.from_user.id
+    keyboard_buttons = [
+        [types.InlineKeyboardButton(text=f"📊 Analyze {part.mountpoint}", callback_data=f"du_{path_token(user_id, part.mountpoint)}")]
+        for part, _ in snapshot["disks"][:6]
+    ]
+    keyboard_buttons.append([types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")])
+    await callback.message.edit_text("\n".join(disks_info), reply_markup=types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons))
 
 @dp.callback_query(F.data == "networkinfo")
 async def networkinfo_handler(callback: types.CallbackQuery):
     """Network information menu"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -758,10 +2610,11 @@ async def networkinfo_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "net_stats")
 async def net_stats_handler(callback: types.CallbackQuery):
     """Show network statistics"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
-    network_info = get_network_info()
+    snapshot = await get_metrics()
+    network_info = get_network_info(snapshot["net"])
     
     try:
         hostname = socket.gethostname()
@@ -785,58 +2638,359 @@ async def net_stats_handler(callback: types.CallbackQuery):
 
 <b>Interfaces:</b>
 {network_info}
+
+{metrics_age_text(snapshot)}
 """
-    await callback.message.edit_text(info, reply_markup=back_to_main_button())
+    try:
+        await callback.message.edit_text(info, reply_markup=back_to_main_button())
+    except Exception as e:
+        logging.error(f"Error showing network stats: {e}")
 
-@dp.callback_query(F.data == "net_speed")
+@dp.callback_query(F.data.in_({"net_speed", "net_speed_force"}))
 async def net_speed_handler(callback: types.CallbackQuery):
     """Run speed test"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
-    await callback.message.edit_text("⏳ <i>Running speed test...</i>")
-    result = await speed_test()
-    await callback.message.edit_text(f"<b>📡 Speed Test</b>\n━━━━━━━━━━━━━━━━━━━━━━\n{result}", reply_markup=back_to_main_button())
+    force = callback.data == "net_speed_force"
+    if force or not cached_speed_test():
+        if speedtest_state["task"] is not None:
+            await callback.message.edit_text("⏳ <i>Speed test already running, waiting for result...</i>")
+        else:
+            await callback.message.edit_text("⏳ <i>Running speed test...</i>")
+    
+    try:
+        result = format_speed_result(await speed_test(force))
+    except Exception as e:
+        logging.error(f"Speed test error: {e}")
+        result = "Speed test error"
+    
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="🔄 Run Again", callback_data="net_speed_force")],
+        [types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")]
+    ])
+    await callback.message.edit_text(f"<b>📡 Speed Test</b>\n━━━━━━━━━━━━━━━━━━━━━━\n{result}", reply_markup=keyboard)
+
+@dp.callback_query(F.data == "net_ping")
+async def net_ping_handler(callback: types.CallbackQuery):
+    """Run ping test"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    hosts = ["8.8.8.8"]
+    await callback.message.edit_text(render_ping_results(hosts, {}))
+    await run_ping_batch(callback.message, hosts, reply_markup=back_to_main_button())
+
+def render_process_page(snapshot, sort, page):
+    """Render one page of the process table sorted by a PROC_SORT_KEYS column"""
+    label, field = PROC_SORT_KEYS[sort]
+    processes = snapshot["processes"]
+    pages = max(1, -(-len(processes) // PROC_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    # Partial sort, only the rows up to the requested page are ordered
+    top = heapq.nlargest((page + 1) * PROC_PAGE_SIZE, processes, key=lambda p: p[field] or 0)
+    
+    text_lines = [
+        f"<b>⚡ Processes</b> ({len(processes)}, by {label}, page {page + 1}/{pages})\n━━━━━━━━━━━━━━━━━━━━━━"
+    ]
+    shown = top[page * PROC_PAGE_SIZE:]
+    for proc in shown:
+        io = f"{format_bytes(proc['io_rate'])}/s" if proc['io_rate'] is not None else "n/a"
+        text_lines.append(f"<b>PID {proc['pid']}</b> | {html.escape(proc['name'][:20])} | {html.escape(proc['username'][:12])}")
+        text_lines.append(f"├─ CPU: {proc['cpu_percent']:.1f}% | MEM: {proc['memory_percent']:.1f}% ({format_bytes(proc['rss'])})")
+        text_lines.append(f"└─ IO: {io} | Threads: {proc['threads']}\n")
+    text_lines.append(f"<i>⚡ Refresh: {process_stats['refresh_ms']:.0f} ms</i>")
+    text_lines.append(metrics_age_text(snapshot))
+    
+    sort_row = [
+        types.InlineKeyboardButton(text=f"{'• ' if key == sort else ''}{name}", callback_data=f"proc_{key}_0")
+        for key, (name, _) in PROC_SORT_KEYS.items()
+    ]
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton(text="⬅️ Prev", callback_data=f"proc_{sort}_{page - 1}"))
+    if page < pages - 1:
+        nav.append(types.InlineKeyboardButton(text="Next ➡️", callback_data=f"proc_{sort}_{page + 1}"))
+    keyboard_buttons = [sort_row]
+    keyboard_buttons.extend(
+        [types.InlineKeyboardButton(text=f"🔍 {proc['pid']}", callback_data=f"pinfo_{proc['pid']}") for proc in shown[i:i + 5]]
+        for i in range(0, len(shown), 5)
+    )
+    if nav:
+        keyboard_buttons.append(nav)
+    keyboard_buttons.append([
+        types.InlineKeyboardButton(text="🔄 Refresh", callback_data=f"proc_{sort}_{page}"),
+        types.InlineKeyboardButton(text="🌳 Tree", callback_data="ptree_all"),
+        types.InlineKeyboardButton(text="🏆 Top", callback_data="top_0")
+    ])
+    keyboard_buttons.append([types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")])
+    return "\n".join(text_lines), types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+@dp.callback_query(F.data == "processes")
+async def processes_handler(callback: types.CallbackQuery):
+    """Show active processes"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    snapshot = await get_metrics()
+    text, keyboard = render_process_page(snapshot, "cpu", 0)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("proc_"))
+async def processes_page_handler(callback: types.CallbackQuery):
+    """Sort or page the process table"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    try:
+        sort, _, page = callback.data[5:].rpartition("_")
+        if sort not in PROC_SORT_KEYS:
+            await callback.answer("❌ Unknown sort")
+            return
+        snapshot = await get_metrics()
+        text, keyboard = render_process_page(snapshot, sort, int(page))
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except Exception as e:
+        logging.error(f"Error in processes_page_handler: {e}")
+        await callback.answer(f"❌ Error: {str(e)}")
+
+def render_top(snapshot, minutes):
+    """Render the top processes of the latest sample or averaged over minutes"""
+    if minutes:
+        hogs, samples = process_hogs(minutes)
+        title = f"<b>🏆 Top Processes</b> (avg of last {minutes} min, {samples} samples)"
+    else:
+        hogs = {metric: top[:PROC_TOP_SHOW] for metric, top in snapshot["process_top"].items()}
+        title = "<b>🏆 Top Processes</b> (latest sample)"
+    
+    lines = [title, "━━━━━━━━━━━━━━━━━━━━━━"]
+    for metric, (label, _, fmt) in PROC_RANK_METRICS.items():
+        lines.append(f"<b>{label}:</b>")
+        ranked = hogs.get(metric)
+        if not ranked:
+            lines.append("└─ n/a")
+        for i, (value, pid, name) in enumerate(ranked or ()):
+            lines.append(f"{'└─' if i == len(ranked) - 1 else '├─'} {fmt(value)} {html.escape(name[:20])} ({pid})")
+        lines.append("")
+    lines.append(metrics_age_text(snapshot))
+    
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=f"{'• ' if window == minutes else ''}{f'{window}m' if window else 'Now'}",
+                                    callback_data=f"top_{window}") for window in PROC_TOP_WINDOWS],
+        [types.InlineKeyboardButton(text="⚡ Processes", callback_data="processes"),
+         types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")]
+    ])
+    return "\n".join(lines), keyboard
+
+@dp.callback_query(F.data.startswith("top_"))
+async def top_handler(callback: types.CallbackQuery):
+    """Switch the top processes window"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    try:
+        snapshot = await get_metrics()
+        text, keyboard = render_top(snapshot, int(callback.data[4:]))
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except Exception as e:
+        logging.error(f"Error in top_handler: {e}")
+        await callback.answer(f"❌ Error: {str(e)}")
+
+PROC_ATTR_TTL = 30
+PROC_TREE_DEPTH = 3
+PROC_TREE_FANOUT = 8
+PROC_TREE_LINES = 60
+
+process_attr_cache = {}
+
+def cached_process_attr(proc, name, func):
+    """Return func() for a process, cached for PROC_ATTR_TTL seconds
+    
+    Keys include the creation time, so a reused PID never sees stale data.
+    """
+    key = (proc.pid, proc.create_time(), name)
+    now = time.monotonic()
+    cached = process_attr_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    if len(process_attr_cache) > 1024:
+        for stale in [k for k, (expires, _) in process_attr_cache.items() if expires <= now]:
+            process_attr_cache.pop(stale, None)
+    try:
+        value = func()
+    except (psutil.AccessDenied, psutil.ZombieProcess):
+        value = None
+    process_attr_cache[key] = (now + PROC_ATTR_TTL, value)
+    return value
+
+def collect_process_detail(pid):
+    """Gather process attributes in one oneshot() pass (blocking)"""
+    proc = psutil.Process(pid)
+    detail = {"pid": pid}
+    with proc.oneshot():
+        for name in ("name", "ppid", "status", "create_time", "num_threads", "cpu_times", "memory_info", "nice"):
+            detail[name] = getattr(proc, name)()
+        for name in ("cmdline", "username", "cwd", "io_counters", "num_fds"):
+            try:
+                detail[name] = getattr(proc, name)()
+            except (psutil.AccessDenied, psutil.ZombieProcess, AttributeError):
+                detail[name] = None
+        detail["memory_full"] = cached_process_attr(proc, "memory_full_info", proc.memory_full_info)
+        detail["open_files"] = cached_process_attr(proc, "open_files", proc.open_files)
+        connections = getattr(proc, "net_connections", None) or proc.connections
+        detail["connections"] = cached_process_attr(proc, "connections", connections)
+    return detail
+
+def format_process_detail(detail, tracked, children):
+    """Render a process detail view"""
+    memory = detail["memory_info"]
+    cmdline = " ".join(detail["cmdline"]) if detail["cmdline"] else "n/a"
+    cpu = f"{tracked['cpu_percent']:.1f}%" if tracked else "n/a"
+    cpu_times = detail["cpu_times"]
+    uss = f" | USS: {format_bytes(detail['memory_full'].uss)}" if detail["memory_full"] else ""
+    io = detail["io_counters"]
+    lines = [
+        f"<b>🔍 PID {detail['pid']}</b> | {html.escape(detail['name'])}",
+        "━━━━━━━━━━━━━━━━━━━━━━",
+        f"<code>{html.escape(cmdline[:300])}</code>",
+        f"├─ User: {html.escape(detail['username'] or 'n/a')} | Status: {detail['status']} | Nice: {detail['nice']}",
+        f"├─ Parent: {detail['ppid']} | Started: {datetime.fromtimestamp(detail['create_time']).strftime('%Y-%m-%d %H:%M:%S')}",
+        f"├─ CWD: {html.escape(detail['cwd'] or 'n/a')}",
+        f"├─ CPU: {cpu} | user {seconds_to_human(int(cpu_times.user))}, system {seconds_to_human(int(cpu_times.system))}",
+        f"├─ Threads: {detail['num_threads']} | FDs: {detail['num_fds'] if detail['num_fds'] is not None else 'n/a'}",
+        f"├─ RSS: {format_bytes(memory.rss)} | VMS: {format_bytes(memory.vms)}{uss}",
+        f"└─ IO: read {format_bytes(io.read_bytes)}, write {format_bytes(io.write_bytes)}" if io else "└─ IO: n/a"
+    ]
+    
+    if detail["open_files"] is not None:
+        lines.append(f"\n<b>Open files ({len(detail['open_files'])}):</b>")
+        lines.extend(f"├─ {html.escape(f.path[-60:])}" for f in detail["open_files"][:5])
+    if detail["connections"] is not None:
+        lines.append(f"\n<b>Connections ({len(detail['connections'])}):</b>")
+        for conn in detail["connections"][:5]:
+            local = f"{conn.laddr.ip}:{conn.laddr.port}" if conn.laddr else "-"
+            remote = f"{conn.raddr.ip}:{conn.raddr.port}" if conn.raddr else "-"
+            lines.append(f"├─ {html.escape(local)} → {html.escape(remote)} {conn.status}")
+    if children:
+        lines.append(f"\n<b>Children ({len(children)}):</b>")
+        lines.extend(f"├─ {child['pid']} {html.escape(child['name'][:20])}" for child in children[:5])
+    return "\n".join(lines)
 
-@dp.callback_query(F.data == "net_ping")
-async def net_ping_handler(callback: types.CallbackQuery):
-    """Run ping test"""
-    if not is_authorized(callback.from_user.id):
-        return
+def build_process_tree(processes):
+    """Index processes by PID and parent, and total CPU/memory for every subtree"""
+    by_pid = {proc["pid"]: proc for proc in processes}
+    children = {}
+    for proc in processes:
+        if proc["ppid"] != proc["pid"]:
+            children.setdefault(proc["ppid"], []).append(proc["pid"])
     
-    await callback.message.edit_text("⏳ <i>Ping test running...</i>")
-    result = await ping_host()
-    await callback.message.edit_text(f"<b>🏓 Ping Test (8.8.8.8)</b>\n━━━━━━━━━━━━━━━━━━━━━━\n<pre>{result}</pre>", reply_markup=back_to_main_button())
+    totals = {}
+    roots = [pid for pid, proc in by_pid.items() if proc["ppid"] not in by_pid or proc["ppid"] == pid]
+    stack = [(pid, False) for pid in roots]
+    while stack:
+        pid, done = stack.pop()
+        if not done:
+            stack.append((pid, True))
+            stack.extend((child, False) for child in children.get(pid, ()))
+            continue
+        proc = by_pid[pid]
+        cpu, mem, count = proc["cpu_percent"], proc["memory_percent"], 1
+        for child in children.get(pid, ()):
+            child_cpu, child_mem, child_count = totals[child]
+            cpu, mem, count = cpu + child_cpu, mem + child_mem, count + child_count
+        totals[pid] = (cpu, mem, count)
+    return by_pid, children, totals, roots
 
-@dp.callback_query(F.data == "processes")
-async def processes_handler(callback: types.CallbackQuery):
-    """Show active processes"""
-    if not is_authorized(callback.from_user.id):
-        return
+def render_process_tree(snapshot, root_pid=None):
+    """Render a collapsed process tree, busiest subtrees first"""
+    by_pid, children, totals, roots = build_process_tree(snapshot["processes"])
+    if root_pid not in by_pid:
+        root_pid = None
+    top = [root_pid] if root_pid is not None else roots
+    busiest = lambda pid: totals[pid][:2]
     
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
-        try:
-            info = proc.info
-            if info['cpu_percent'] > 0 or info['memory_percent'] > 0.1:
-                processes.append(info)
-        except:
+    lines = []
+    stack = [(pid, 0, 0) for pid in sorted(top, key=busiest)[-PROC_TREE_FANOUT:]]
+    while stack and len(lines) < PROC_TREE_LINES:
+        pid, depth, hidden = stack.pop()
+        indent = "  " * depth + ("└ " if depth else "")
+        if pid is None:
+            lines.append(f"{indent}… {hidden} more")
             continue
+        proc = by_pid[pid]
+        cpu, mem, count = totals[pid]
+        kids = sorted(children.get(pid, ()), key=busiest, reverse=True)
+        collapsed = f" [+{count - 1}]" if kids and depth >= PROC_TREE_DEPTH else ""
+        lines.append(f"{indent}<b>{pid}</b> {html.escape(proc['name'][:18])} {cpu:.1f}%/{mem:.1f}%{collapsed}")
+        if kids and depth < PROC_TREE_DEPTH:
+            if len(kids) > PROC_TREE_FANOUT:
+                stack.append((None, depth + 1, len(kids) - PROC_TREE_FANOUT))
+            stack.extend((child, depth + 1, 0) for child in reversed(kids[:PROC_TREE_FANOUT]))
+    
+    title = "<b>🌳 Process Tree</b>" + (f" of {root_pid}" if root_pid is not None else f" ({len(by_pid)} processes)")
+    text = f"{title}\n<i>CPU%/MEM% include children</i>\n━━━━━━━━━━━━━━━━━━━━━━\n" + "\n".join(lines)
+    if stack:
+        text += "\n…"
+    text += f"\n{metrics_age_text(snapshot)}"
     
-    processes.sort(key=lambda x: x['memory_percent'] or 0, reverse=True)
+    candidates = children.get(root_pid, []) if root_pid is not None else roots
+    drill = [pid for pid in sorted(candidates, key=busiest, reverse=True) if pid in children][:6]
+    keyboard_buttons = [
+        [types.InlineKeyboardButton(text=f"🌳 {pid} {by_pid[pid]['name'][:10]}", callback_data=f"ptree_{pid}") for pid in drill[i:i + 2]]
+        for i in range(0, len(drill), 2)
+    ]
+    if root_pid is not None:
+        keyboard_buttons.append([
+            types.InlineKeyboardButton(text="🔍 Details", callback_data=f"pinfo_{root_pid}"),
+            types.InlineKeyboardButton(text="⬆️ Parent", callback_data=f"ptree_{by_pid[root_pid]['ppid']}")
+        ])
+    keyboard_buttons.append([types.InlineKeyboardButton(text="🔙 Processes", callback_data="processes")])
+    return text, types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+@dp.callback_query(F.data.startswith("ptree_"))
+async def process_tree_handler(callback: types.CallbackQuery):
+    """Show the process tree, optionally rooted at a PID"""
+    if not await is_authorized(callback.from_user.id):
+        return
     
-    text_lines = ["<b>⚡ Active Processes</b>\n━━━━━━━━━━━━━━━━━━━━━━"]
-    for proc in processes[:15]:
-        text_lines.append(f"<b>PID {proc['pid']}</b> | {proc['name'][:20]}")
-        text_lines.append(f"├─ CPU: {proc['cpu_percent']}%")
-        text_lines.append(f"└─ MEM: {proc['memory_percent']:.1f}%\n")
+    try:
+        root = callback.data[6:]
+        snapshot = await get_metrics()
+        text, keyboard = render_process_tree(snapshot, int(root) if root != "all" else None)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except Exception as e:
+        logging.error(f"Error in process_tree_handler: {e}")
+        await callback.answer(f"❌ Error: {str(e)}")
+
+@dp.callback_query(F.data.startswith("pinfo_"))
+async def process_detail_handler(callback: types.CallbackQuery):
+    """Show details of a single process"""
+    if not await is_authorized(callback.from_user.id):
+        return
     
-    await callback.message.edit_text("\n".join(text_lines), reply_markup=back_to_main_button())
+    pid = int(callback.data[6:])
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="🔄 Refresh", callback_data=f"pinfo_{pid}"),
+         types.InlineKeyboardButton(text="🌳 Subtree", callback_data=f"ptree_{pid}")],
+        [types.InlineKeyboardButton(text="🔙 Processes", callback_data="processes")]
+    ])
+    try:
+        loop = asyncio.get_running_loop()
+        detail = await loop.run_in_executor(None, collect_process_detail, pid)
+        snapshot = await get_metrics()
+        tracked = next((p for p in snapshot["processes"] if p["pid"] == pid), None)
+        children = [p for p in snapshot["processes"] if p["ppid"] == pid and p["pid"] != pid]
+        await callback.message.edit_text(format_process_detail(detail, tracked, children), reply_markup=keyboard)
+    except psutil.NoSuchProcess:
+        await callback.message.edit_text(f"❌ Process {pid} no longer exists", reply_markup=keyboard)
+    except Exception as e:
+        logging.error(f"Error in process_detail_handler: {e}")
+        await callback.answer(f"❌ Error: {str(e)}")
 
 @dp.callback_query(F.data == "files")
 async def files_handler(callback: types.CallbackQuery):
     """File manager menu"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     user_states[callback.from_user.id] = {"path": os.path.expanduser("~")}
@@ -852,7 +3006,7 @@ async def files_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("nav_"))
 async def navigate_handler(callback: types.CallbackQuery):
     """Navigate to predefined directories"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     paths = {
@@ -866,77 +3020,338 @@ async def navigate_handler(callback: types.CallbackQuery):
     
     await list_directory(callback)
 
-async def list_directory(callback: types.CallbackQuery, path=None):
-    """List directory contents"""
-    if not is_authorized(callback.from_user.id):
-        return
+PATH_TOKEN_LIMIT = 512
+PATH_TOKEN_TTL = 3600
+
+# Per-user LRU of callback tokens: user_id -> {token: (path, expires_at)}
+path_tokens = {}
+path_token_ids = {}
+path_token_counter = itertools.count(1)
+
+def path_token(user_id, path):
+    """Return a short callback token for a path, reusing the user's live token"""
+    tokens = path_tokens.setdefault(user_id, OrderedDict())
+    ids = path_token_ids.setdefault(user_id, {})
+    token = ids.get(path)
+    if token is None:
+        token = format(next(path_token_counter), "x")
+        ids[path] = token
+    tokens[token] = (path, time.monotonic() + PATH_TOKEN_TTL)
+    tokens.move_to_end(token)
+    while len(tokens) > PATH_TOKEN_LIMIT:
+        _, (evicted, _) = tokens.popitem(last=False)
+        ids.pop(evicted, None)
+    return token
+
+def resolve_path_token(user_id, token):
+    """Return the path of a user's token, None when unknown or expired"""
+    tokens = path_tokens.get(user_id)
+    entry = tokens.get(token) if tokens else None
+    if entry is None:
+        return None
+    path, expires_at = entry
+    if expires_at < time.monotonic():
+        del tokens[token]
+        path_token_ids[user_id].pop(path, None)
+        return None
+    tokens.move_to_end(token)
+    return path
+
+async def callback_path(callback, prefix):
+    """Resolve the path token of a file manager button, answering when it expired"""
+    path = resolve_path_token(callback.from_user.id, callback.data[len(prefix):])
+    if path is None:
+        await callback.answer("⌛ Button expired, open the folder again")
+    return path
+
+DIR_CACHE_SIZE = 32
+DIR_CACHE_MAX_ENTRIES = 200000
+DIR_CACHE_MAX_AGE = 60
+FILE_PAGE_SIZE = 20
+FILE_SORT_KEYS = {
+    "name": ("Name", lambda e: (e[0], e[1])),
+    "size": ("Size", lambda e: (e[0], -e[2], e[1])),
+    "mtime": ("Modified", lambda e: (e[0], -e[3], e[1]))
+}
+
+dir_cache = OrderedDict()
+# Per-user sort, filter and page cursors of the file manager
+file_browser_views = {}
+dir_cache_lock = threading.Lock()
+dir_cache_stats = {"hits": 0, "scans": 0, "entries": 0}
+
+def scan_directory(path):
+    """Read a directory with os.scandir, one stat per entry (blocking)
     
-    user_state = user_states.get(callback.from_user.id, {"path": os.path.expanduser("~")})
-    current_path = path or user_state["path"]
+    Entries are (is_file, name, size, mtime) tuples, so folders sort first.
+    """
+    started = time.perf_counter()
+    entries = []
+    dirs = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                st = entry.stat()
+            except OSError:
+                # Broken symlinks, or entries removed while scanning
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+            # is_dir() reuses d_type, or the cached stat for symlinks
+            if entry.is_dir():
+                entries.append((False, entry.name, 0, st.st_mtime))
+                dirs += 1
+            else:
+                entries.append((True, entry.name, st.st_size, st.st_mtime))
+    return {
+        "entries": entries,
+        "dirs": dirs,
+        "files": len(entries) - dirs,
+        "scan_ms": (time.perf_counter() - started) * 1000
+    }
+
+def get_directory_snapshot(path, pinned=None):
+    """Return a directory snapshot, rescanning only when it changed (blocking)
     
-    try:
-        items = os.listdir(current_path)
-    except Exception as e:
-        await callback.message.edit_text(f"❌ Error: {e}", reply_markup=back_to_main_button())
-        return
+    A cached snapshot is reused while the directory mtime is unchanged.
+    File sizes can change without touching the directory, so snapshots
+    older than DIR_CACHE_MAX_AGE seconds are rescanned as well.
+    pinned is the snapshot a view is paging through; it is reused even when
+    other directories pushed it out of the cache.
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    now = time.monotonic()
+    with dir_cache_lock:
+        cached = dir_cache.get(path)
+        if cached and cached["mtime_ns"] == mtime_ns and now - cached["scanned_at"] < DIR_CACHE_MAX_AGE:
+            dir_cache.move_to_end(path)
+            dir_cache_stats["hits"] += 1
+            return dict(cached, cached=True)
+        if pinned and pinned["path"] == path and pinned["mtime_ns"] == mtime_ns and now - pinned["scanned_at"] < DIR_CACHE_MAX_AGE:
+            dir_cache_stats["hits"] += 1
+            return dict(pinned, cached=True)
     
-    dirs = []
-    files = []
+    snapshot = scan_directory(path)
+    snapshot.update(path=path, mtime_ns=mtime_ns, scanned_at=now, cached=False, orders={}, matches={},
+                    weight=len(snapshot["entries"]))
+    with dir_cache_lock:
+        dir_cache_stats["scans"] += 1
+        old = dir_cache.pop(path, None)
+        if old:
+            dir_cache_stats["entries"] -= old["weight"]
+        dir_cache[path] = snapshot
+        dir_cache_stats["entries"] += snapshot["weight"]
+        trim_dir_cache()
+    return snapshot
+
+def trim_dir_cache():
+    """Evict least recently used snapshots beyond the cache limits (hold dir_cache_lock)
     
-    for item in sorted(items)[:50]:
-        full_path = os.path.join(current_path, item)
-        try:
-            if os.path.isdir(full_path):
-                dirs.append(item)
-            else:
-                size = os.path.getsize(full_path)
-                files.append((item, size))
-        except:
-            continue
+    Weights count entries plus the key lists of memoized sort orders. The
+    most recent snapshot always stays, so one directory larger than
+    DIR_CACHE_MAX_ENTRIES is still cached on its own.
+    """
+    while len(dir_cache) > 1 and (len(dir_cache) > DIR_CACHE_SIZE or dir_cache_stats["entries"] > DIR_CACHE_MAX_ENTRIES):
+        _, evicted = dir_cache.popitem(last=False)
+        dir_cache_stats["entries"] -= evicted["weight"]
+
+def sorted_entries(snapshot, sort):
+    """Return (entries, keys) of a snapshot in sort order, sorted once per snapshot"""
+    order = snapshot["orders"].get(sort)
+    if order is None:
+        key = FILE_SORT_KEYS[sort][1]
+        entries = sorted(snapshot["entries"], key=key)
+        order = (entries, [key(e) for e in entries])
+        with dir_cache_lock:
+            if sort in snapshot["orders"]:
+                return snapshot["orders"][sort]
+            snapshot["orders"][sort] = order
+            cached = dir_cache.get(snapshot["path"])
+            if cached is not None and cached["orders"] is snapshot["orders"]:
+                cached["weight"] += len(entries)
+                dir_cache_stats["entries"] += len(entries)
+                dir_cache.move_to_end(snapshot["path"])
+                trim_dir_cache()
+    return order
+
+def directory_page(snapshot, sort, needle, direction=None, cursor=None):
+    """Select one page of a snapshot after or before a cursor key (blocking)
     
-    keyboard_buttons = []
+    Returns (entries, has_prev, has_next, matched). Each sort order is built
+    once per cached snapshot and pages are found by bisecting its keys, so
+    paging never rescans or re-sorts the directory.
+    """
+    entries, keys = sorted_entries(snapshot, sort)
+    if direction == "next":
+        start, step = bisect.bisect_right(keys, cursor), 1
+    elif direction == "prev":
+        start, step = bisect.bisect_left(keys, cursor) - 1, -1
+    else:
+        start, step = 0, 1
     
-    if current_path != "/":
-        parent_dir = os.path.dirname(current_path)
-        keyboard_buttons.append([
-            types.InlineKeyboardButton(text="⬆️ Up", callback_data=f"dir_{parent_dir}")
-        ])
+    if needle:
+        matched = snapshot["matches"].get(needle)
+        if matched is None:
+            matched = snapshot["matches"][needle] = sum(needle in e[1].lower() for e in entries)
+        page = []
+        index = start
+        while 0 <= index < len(entries) and len(page) <= FILE_PAGE_SIZE:
+            if needle in entries[index][1].lower():
+                page.append(entries[index])
+            index += step
+    else:
+        matched = len(entries)
+        page = entries[start:start + FILE_PAGE_SIZE + 1] if step > 0 else entries[max(0, start - FILE_PAGE_SIZE):start + 1][::-1]
     
-    for dir_name in dirs[:20]:
-        keyboard_buttons.append([
-            types.InlineKeyboardButton(text=f"📁 {dir_name}", callback_data=f"dir_{os.path.join(current_path, dir_name)}")
-        ])
+    more = len(page) > FILE_PAGE_SIZE
+    page = page[:FILE_PAGE_SIZE]
+    if step < 0:
+        return page[::-1], more, True, matched
+    return page, direction == "next", more, matched
+
+def load_directory_page(path, view, direction):
+    """Snapshot a directory and select the page for a view (blocking)"""
+    snapshot = get_directory_snapshot(path, view.get("snapshot"))
+    cursor = view.get("last") if direction == "next" else view.get("first")
+    return snapshot, directory_page(snapshot, view["sort"], view["filter"], direction, cursor)
+
+async def render_directory(user_id, path, direction=None):
+    """Render a file manager page, returns (text, keyboard)"""
+    view = file_browser_views.get(user_id)
+    if view is None or view["path"] != path:
+        view = {"path": path, "sort": view["sort"] if view else "name", "filter": "", "page": 0}
+        file_browser_views[user_id] = view
+    if direction is None or view.get("first") is None:
+        direction = None
+        view["page"] = 0
+    
+    loop = asyncio.get_running_loop()
+    snapshot, (entries, has_prev, has_next, matched) = await loop.run_in_executor(
+        None, load_directory_page, path, view, direction
+    )
+    # Keep the snapshot being paged, even if the cache evicts it
+    view["snapshot"] = snapshot
+    key = FILE_SORT_KEYS[view["sort"]][1]
+    if entries:
+        view["first"], view["last"] = key(entries[0]), key(entries[-1])
+    view["page"] += {"next": 1, "prev": -1}.get(direction, 0)
+    
+    keyboard_buttons = []
     
-    for file_name, size in files[:20]:
-        size_str = f"{size // 1024}KB" if size < 1024*1024 else f"{size // 1024**2}MB"
+    if path != "/":
+        parent_dir = os.path.dirname(path)
         keyboard_buttons.append([
-            types.InlineKeyboardButton(text=f"📄 {file_name} ({size_str})", callback_data=f"file_{os.path.join(current_path, file_name)}")
+            types.InlineKeyboardButton(text="⬆️ Up", callback_data=f"dir_{path_token(user_id, parent_dir)}")
         ])
     
+    for is_file, name, size, _ in entries:
+        if not is_file:
+            keyboard_buttons.append([
+                types.InlineKeyboardButton(text=f"📁 {name}", callback_data=f"dir_{path_token(user_id, os.path.join(path, name))}")
+            ])
+        else:
+            size_str = f"{size // 1024}KB" if size < 1024*1024 else f"{size // 1024**2}MB"
+            keyboard_buttons.append([
+                types.InlineKeyboardButton(text=f"📄 {name} ({size_str})", callback_data=f"file_{path_token(user_id, os.path.join(path, name))}")
+            ])
+    
+    nav = []
+    if has_prev:
+        nav.append(types.InlineKeyboardButton(text="⬅️ Prev", callback_data="fm_prev"))
+    if has_next:
+        nav.append(types.InlineKeyboardButton(text="Next ➡️", callback_data="fm_next"))
+    if nav:
+        keyboard_buttons.append(nav)
+    keyboard_buttons.append([
+        types.InlineKeyboardButton(text=f"{'• ' if sort == view['sort'] else ''}{label}", callback_data=f"fm_sort_{sort}")
+        for sort, (label, _) in FILE_SORT_KEYS.items()
+    ])
+    keyboard_buttons.append([
+        types.InlineKeyboardButton(text="🔎 Filter", callback_data="fm_filter")
+        if not view["filter"] else types.InlineKeyboardButton(text="✖️ Clear Filter", callback_data="fm_clear"),
+        types.InlineKeyboardButton(text="📊 Disk Usage", callback_data=f"du_{path_token(user_id, path)}")
+    ])
     keyboard_buttons.append([types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")])
     
-    text = f"<b>📁 {current_path}</b>\n"
-    text += f"📁 Folders: {len(dirs)} | 📄 Files: {len(files)}\n━━━━━━━━━━━━━━━━━━━━━━"
+    pages = max(1, -(-matched // FILE_PAGE_SIZE))
+    text = f"<b>📁 {html.escape(path)}</b>\n"
+    text += f"📁 Folders: {snapshot['dirs']} | 📄 Files: {snapshot['files']}\n"
+    if view["filter"]:
+        text += f"🔎 Filter: <code>{html.escape(view['filter'])}</code> ({matched} matches)\n"
+    text += f"Page {view['page'] + 1}/{pages}, by {FILE_SORT_KEYS[view['sort']][0].lower()}\n━━━━━━━━━━━━━━━━━━━━━━\n"
+    text += "<i>⚡ cached</i>" if snapshot["cached"] else f"<i>⚡ Scanned in {snapshot['scan_ms']:.0f} ms</i>"
+    return text, types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+async def list_directory(callback: types.CallbackQuery, path=None, direction=None):
+    """List directory contents"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    user_state = user_states.get(callback.from_user.id, {"path": os.path.expanduser("~")})
+    current_path = path or user_state.get("path") or os.path.expanduser("~")
     
-    await callback.message.edit_text(text, reply_markup=types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons))
+    try:
+        text, keyboard = await render_directory(callback.from_user.id, current_path, direction)
+    except Exception as e:
+        await callback.message.edit_text(f"❌ Error: {e}", reply_markup=back_to_main_button())
+        return
+    
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("fm_"))
+async def file_browser_handler(callback: types.CallbackQuery):
+    """Page, sort or filter the current file manager listing"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    user_id = callback.from_user.id
+    action = callback.data[3:]
+    view = file_browser_views.get(user_id)
+    path = user_states.get(user_id, {}).get("path") or (view and view["path"]) or os.path.expanduser("~")
+    
+    if action in ("next", "prev"):
+        await list_directory(callback, path, action)
+    elif action.startswith("sort_") and action[5:] in FILE_SORT_KEYS:
+        if view:
+            view.update(sort=action[5:], first=None)
+        else:
+            file_browser_views[user_id] = {"path": path, "sort": action[5:], "filter": "", "page": 0}
+        await list_directory(callback, path)
+    elif action == "filter":
+        user_states[user_id] = {"path": path, "mode": "wait_file_filter"}
+        await callback.message.edit_text(
+            "🔎 <b>Filter Files</b>\n\nEnter part of a file or folder name:",
+            reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text="❌ Cancel", callback_data=f"dir_{path_token(user_id, path)}")]
+            ])
+        )
+    elif action == "clear":
+        if view:
+            view.update(filter="", first=None)
+        await list_directory(callback, path)
 
 @dp.callback_query(F.data.startswith("dir_"))
 async def change_directory(callback: types.CallbackQuery):
     """Change directory in file manager"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
-    new_path = callback.data[4:]
+    new_path = await callback_path(callback, "dir_")
+    if new_path is None:
+        return
     user_states[callback.from_user.id] = {"path": new_path}
     await list_directory(callback, new_path)
 
 @dp.callback_query(F.data.startswith("file_"))
 async def handle_file(callback: types.CallbackQuery):
     """Handle file selection in file manager"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
-    file_path = callback.data[5:]
+    file_path = await callback_path(callback, "file_")
+    if file_path is None:
+        return
     
     if not os.path.exists(file_path):
         await callback.answer("❌ File not found")
@@ -944,40 +3359,225 @@ async def handle_file(callback: types.CallbackQuery):
     
     file_size = os.path.getsize(file_path)
     
-    if file_size > 50 * 1024 * 1024:
-        await callback.answer("❌ File too large (>50MB)")
+    if file_size > DOWNLOAD_MAX_SIZE:
+        await callback.answer(f"❌ File too large (>{format_bytes(DOWNLOAD_MAX_SIZE)})")
         return
     
+    user_id = callback.from_user.id
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-        [types.InlineKeyboardButton(text="⬇️ Download", callback_data=f"download_{file_path}")],
-        [types.InlineKeyboardButton(text="👁️ View", callback_data=f"view_{file_path}")],
-        [types.InlineKeyboardButton(text="🔙 Back", callback_data=f"dir_{os.path.dirname(file_path)}")]
+        [types.InlineKeyboardButton(text="⬇️ Download", callback_data=f"download_{path_token(user_id, file_path)}")],
+        [types.InlineKeyboardButton(text="👁️ View", callback_data=f"view_{path_token(user_id, file_path)}")],
+        [types.InlineKeyboardButton(text="🔙 Back", callback_data=f"dir_{path_token(user_id, os.path.dirname(file_path))}")]
     ])
     
     size_str = f"{file_size // 1024}KB" if file_size < 1024*1024 else f"{file_size // 1024**2}MB"
-    await callback.message.edit_text(f"<b>📄 {os.path.basename(file_path)}</b>\nSize: {size_str}\nPath: {file_path}", reply_markup=keyboard)
+    delivery = ""
+    if file_size > DOWNLOAD_PART_SIZE:
+        delivery = f"\nDelivery: up to {-(-file_size // DOWNLOAD_PART_SIZE)} parts of {format_bytes(DOWNLOAD_PART_SIZE)}"
+    await callback.message.edit_text(
+        f"<b>📄 {html.escape(os.path.basename(file_path))}</b>\nSize: {size_str}\nPath: {html.escape(file_path)}{delivery}",
+        reply_markup=keyboard
+    )
+
+DOWNLOAD_MAX_SIZE = 2 * 1024**3
+DOWNLOAD_PART_SIZE = 48 * 1024 * 1024
+DOWNLOAD_GZIP_THRESHOLD = 4 * 1024 * 1024
+DOWNLOAD_MIN_SAVING = 0.9
+DOWNLOAD_READ_SIZE = 1024 * 1024
+DOWNLOAD_MAX_ACTIVE = 2
+DOWNLOAD_PROGRESS_INTERVAL = 3.0
+DOWNLOAD_UPLOAD_TIMEOUT = 900
+DOWNLOAD_COMPRESSED_EXTENSIONS = {
+    ".gz", ".tgz", ".zip", ".xz", ".bz2", ".zst", ".7z", ".rar", ".br", ".lz4",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".webm", ".avi", ".deb", ".rpm"
+}
+
+download_active = set()
+
+def download_slots():
+    """Semaphore limiting concurrent transfers to DOWNLOAD_MAX_ACTIVE"""
+    return loop_primitive("download", lambda: asyncio.Semaphore(DOWNLOAD_MAX_ACTIVE))
+
+class FileRangeInput(InputFile):
+    """Upload a byte range of a file, read from disk chunk by chunk"""
+    
+    def __init__(self, path, offset, length, filename, progress=None):
+        super().__init__(filename=filename, chunk_size=DOWNLOAD_READ_SIZE)
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.progress = progress
+    
+    async def read(self, bot):
+        loop = asyncio.get_running_loop()
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = await loop.run_in_executor(None, f.read, min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if self.progress is not None:
+                    self.progress["done"] += len(chunk)
+                yield chunk
+
+def sample_compression_ratio(path):
+    """Estimate how well a file compresses from its first chunk (blocking)"""
+    with open(path, "rb") as f:
+        chunk = f.read(DOWNLOAD_READ_SIZE)
+    return len(gzip.compress(chunk, compresslevel=1)) / len(chunk) if chunk else 1.0
+
+def compress_for_download(src, dst, progress):
+    """Gzip src into dst chunk by chunk, counting input bytes in progress (blocking)"""
+    with open(src, "rb") as f, gzip.open(dst, "wb", compresslevel=6) as out:
+        while True:
+            chunk = f.read(DOWNLOAD_READ_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            progress["done"] += len(chunk)
+
+def hash_download_parts(path, progress):
+    """Split a file into DOWNLOAD_PART_SIZE ranges, returns ([(offset, length, sha256)], sha256) (blocking)"""
+    parts = []
+    total = hashlib.sha256()
+    offset = 0
+    with open(path, "rb") as f:
+        while True:
+            part = hashlib.sha256()
+            length = 0
+            while length < DOWNLOAD_PART_SIZE:
+                chunk = f.read(min(DOWNLOAD_READ_SIZE, DOWNLOAD_PART_SIZE - length))
+                if not chunk:
+                    break
+                part.update(chunk)
+                total.update(chunk)
+                length += len(chunk)
+                progress["done"] += len(chunk)
+            if length == 0 and parts:
+                break
+            parts.append((offset, length, part.hexdigest()))
+            offset += length
+            if length < DOWNLOAD_PART_SIZE:
+                break
+    return parts, total.hexdigest()
+
+async def download_progress_editor(status, name, progress):
+    """Periodically edit the status message with download progress"""
+    while True:
+        await asyncio.sleep(DOWNLOAD_PROGRESS_INTERVAL)
+        elapsed = time.monotonic() - progress["started"]
+        percent = progress["done"] / progress["total"] * 100 if progress["total"] else 100
+        rate = progress["done"] / elapsed if elapsed > 0 else 0
+        try:
+            await status.edit_text(
+                f"⬇️ <b>{html.escape(name)}</b>\n{progress['stage']}: {percent:.0f}% "
+                f"({format_bytes(progress['done'])}/{format_bytes(progress['total'])}, {format_bytes(rate)}/s)"
+            )
+        except Exception as e:
+            logging.error(f"Error updating download progress: {e}")
+
+async def send_large_file(chat_id, path, status, name=None):
+    """Stream a file to chat, gzipped when worthwhile and split into checksummed parts"""
+    loop = asyncio.get_running_loop()
+    size = os.path.getsize(path)
+    name = name or os.path.basename(path)
+    if not size:
+        # Telegram rejects empty documents, and there is nothing to split
+        await status.edit_text(f"📭 <b>{html.escape(name)}</b> is empty, nothing to send")
+        return
+    progress = {"stage": "Preparing", "done": 0, "total": size, "started": time.monotonic()}
+    editor = asyncio.create_task(download_progress_editor(status, name, progress))
+    try:
+        with temp_spool_path("bot_download_", ".gz") as spool:
+            source, filename = path, name
+            compress = (size > DOWNLOAD_GZIP_THRESHOLD
+                        and os.path.splitext(name)[1].lower() not in DOWNLOAD_COMPRESSED_EXTENSIONS
+                        and await loop.run_in_executor(None, sample_compression_ratio, path) < DOWNLOAD_MIN_SAVING)
+            if compress:
+                progress["stage"] = "Compressing"
+                await loop.run_in_executor(None, compress_for_download, path, spool, progress)
+                if os.path.getsize(spool) < size * DOWNLOAD_MIN_SAVING:
+                    source, filename = spool, name + ".gz"
+            
+            progress.update(stage="Checksumming", done=0, total=os.path.getsize(source), started=time.monotonic())
+            parts, digest = await loop.run_in_executor(None, hash_download_parts, source, progress)
+            
+            progress.update(stage="Uploading", done=0, started=time.monotonic())
+            for number, (offset, length, part_digest) in enumerate(parts, 1):
+                if len(parts) == 1:
+                    part_name = filename
+                    caption = f"📄 {html.escape(filename)} ({format_bytes(length)})\nSHA-256: <code>{digest}</code>"
+                else:
+                    part_name = f"{filename}.part{number:03d}"
+                    caption = f"📦 Part {number}/{len(parts)} of {html.escape(filename)}\nSHA-256: <code>{part_digest}</code>"
+                progress["stage"] = f"Uploading part {number}/{len(parts)}" if len(parts) > 1 else "Uploading"
+                await bot.send_document(
+                    chat_id, FileRangeInput(source, offset, length, part_name, progress),
+                    caption=caption, request_timeout=DOWNLOAD_UPLOAD_TIMEOUT
+                )
+            
+            if len(parts) > 1:
+                manifest = "\n".join(f"{d}  {filename}.part{n:03d}" for n, (_, _, d) in enumerate(parts, 1))
+                await bot.send_message(
+                    chat_id,
+                    f"🧩 <b>{html.escape(filename)}</b>: {len(parts)} parts\n"
+                    f"<pre>{html.escape(manifest)}\n{digest}  {html.escape(filename)}</pre>\n"
+                    f"Join with <code>cat {html.escape(filename)}.part* &gt; {html.escape(filename)}</code>"
+                    + (f", then <code>gunzip {html.escape(filename)}</code>" if filename != name else "")
+                )
+    finally:
+        editor.cancel()
+    
+    elapsed = time.monotonic() - progress["started"]
+    sent = progress["total"]
+    await status.edit_text(
+        f"✅ <b>{html.escape(name)}</b> sent: {format_bytes(sent)} in {len(parts)} part(s), "
+        f"{elapsed:.1f}s ({format_bytes(sent / elapsed if elapsed > 0 else sent)}/s)"
+        + (f"\n🗜️ gzip, {format_bytes(size)} raw" if source != path else "")
+    )
 
 @dp.callback_query(F.data.startswith("download_"))
 async def download_file(callback: types.CallbackQuery):
     """Download a file"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    file_path = await callback_path(callback, "download_")
+    if file_path is None:
         return
     
-    file_path = callback.data[9:]
+    user_id = callback.from_user.id
+    if user_id in download_active:
+        await callback.answer("⏳ A download is already in progress")
+        return
     
+    download_active.add(user_id)
     try:
-        await bot.send_document(callback.from_user.id, InputFile(file_path))
-        await callback.answer("✅ File sent")
+        await log_action(user_id, "download_file", file_path)
+        await callback.answer("⬇️ Download started")
+        waiting = download_slots().locked()
+        status = await callback.message.answer(
+            "⏳ <i>Waiting for a free transfer slot...</i>" if waiting else "⬇️ <i>Preparing download...</i>"
+        )
+        async with download_slots():
+            await send_large_file(user_id, file_path, status)
     except Exception as e:
-        await callback.answer(f"❌ Error: {e}")
+        logging.error(f"Error in download_file: {e}")
+        await callback.message.answer(f"❌ Download failed: {html.escape(str(e))}")
+    finally:
+        download_active.discard(user_id)
 
 @dp.callback_query(F.data.startswith("view_"))
 async def view_file(callback: types.CallbackQuery):
     """View file content"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
-    file_path = callback.data[5:]
+    file_path = await callback_path(callback, "view_")
+    if file_path is None:
+        return
     
     try:
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
@@ -988,10 +3588,239 @@ async def view_file(callback: types.CallbackQuery):
     except Exception as e:
         await callback.answer(f"❌ Error: {e}")
 
+DU_WORKERS = 8
+DU_TOP = 10
+DU_PROGRESS_INTERVAL = 2.0
+DU_CACHE_SIZE = 16
+DU_CACHE_MAX_AGE = 600
+DU_MAX_LINKS = 1000000
+
+du_scans = {}
+du_cache = OrderedDict()
+
+def du_scan_dir(path, bucket, device, used):
+    """Sum one directory and its files, without following symlinks or leaving the device (blocking)
+    
+    used is the space of the directory itself, as stat'ed by the parent scan.
+    Sizes are allocated blocks like du, so sparse files count what they use.
+    """
+    size = used
+    files = errors = 0
+    subdirs = []
+    biggest = []
+    linked = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    if entry.is_dir(follow_symlinks=False):
+                        if st.st_dev == device:
+                            subdirs.append((entry.path, st.st_blocks * 512))
+                        continue
+                except OSError:
+                    errors += 1
+                    continue
+                used = st.st_blocks * 512
+                if st.st_nlink > 1:
+                    # Hard links are counted once, by the walker
+                    linked.append((st.st_ino, used, entry.path))
+                    continue
+                size += used
+                files += 1
+                if len(biggest) < DU_TOP:
+                    heapq.heappush(biggest, (used, entry.path))
+                elif used > biggest[0][0]:
+                    heapq.heapreplace(biggest, (used, entry.path))
+    except OSError:
+        errors += 1
+    return bucket, size, files, errors, subdirs, biggest, linked
+
+def du_walk(scan):
+    """Walk a tree with DU_WORKERS concurrent scandir calls, updating scan in place (blocking)
+    
+    Memory stays bounded on huge trees: only totals per top-level child,
+    the stack of pending directories, top DU_TOP heaps and the inodes of
+    hard-linked files are kept. At most DU_MAX_LINKS inodes are remembered,
+    past that further hard links may be counted more than once.
+    """
+    root = scan["path"]
+    root_stat = os.stat(root)
+    device = root_stat.st_dev
+    stack = []
+    seen_links = set()
+    with ThreadPoolExecutor(max_workers=DU_WORKERS, thread_name_prefix="bot_du") as pool:
+        pending = {pool.submit(du_scan_dir, root, None, device, root_stat.st_blocks * 512)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            with scan["lock"]:
+                for future in done:
+                    bucket, size, files, errors, subdirs, biggest, linked = future.result()
+                    for inode, used, path in linked:
+                        if inode not in seen_links:
+                            if len(seen_links) < DU_MAX_LINKS:
+                                seen_links.add(inode)
+                            size += used
+                            files += 1
+                            biggest.append((used, path))
+                    scan["bytes"] += size
+                    scan["files"] += files
+                    scan["errors"] += errors
+                    scan["dirs"] += 1
+                    scan["children"][bucket or root] += size
+                    for item in biggest:
+                        if len(scan["biggest"]) < DU_TOP:
+                            heapq.heappush(scan["biggest"], item)
+                        elif item > scan["biggest"][0]:
+                            heapq.heapreplace(scan["biggest"], item)
+                    # Depth-first order keeps the pending stack small
+                    stack.extend((sub, bucket or sub, used) for sub, used in subdirs)
+            if scan["cancel"].is_set():
+                for future in pending:
+                    future.cancel()
+                break
+            while stack and len(pending) < DU_WORKERS * 2:
+                sub, bucket, used = stack.pop()
+                pending.add(pool.submit(du_scan_dir, sub, bucket, device, used))
+
+def render_du(scan):
+    """Render disk usage results of a running, finished or cached scan"""
+    with scan["lock"]:
+        children = scan["children"].most_common(DU_TOP)
+        biggest = sorted(scan["biggest"], reverse=True)
+        totals = (scan["bytes"], scan["files"], scan["dirs"], scan["errors"])
+    
+    if scan["status"] == "running":
+        status = f"⏳ Scanning... {time.monotonic() - scan['started']:.0f}s"
+    elif scan["status"] == "cancelled":
+        status = "⛔ Cancelled, partial results"
+    elif scan["status"] == "cached":
+        status = f"💾 Cached, scanned {seconds_to_human(int(time.monotonic() - scan['finished_at']))} ago"
+    else:
+        status = f"✅ Done in {scan['elapsed']:.1f}s"
+    lines = [
+        f"<b>📊 Disk Usage</b> <code>{html.escape(scan['path'])}</code>",
+        "━━━━━━━━━━━━━━━━━━━━━━",
+        f"{format_bytes(totals[0])} in {totals[1]} files, {totals[2]} folders" + (f", {totals[3]} errors" if totals[3] else ""),
+        f"<i>{status}</i>",
+        "",
+        "<b>Largest entries:</b>"
+    ]
+    for path, size in children:
+        name = "(files here)" if path == scan["path"] else os.path.basename(path) + "/"
+        percent = size / totals[0] * 100 if totals[0] else 0
+        lines.append(f"├─ {format_bytes(size)} ({percent:.0f}%) {html.escape(name[:40])}")
+    lines.append("\n<b>Largest files:</b>")
+    for size, path in biggest:
+        name = os.path.relpath(path, scan["path"])
+        name = "…" + name[-49:] if len(name) > 50 else name
+        lines.append(f"├─ {format_bytes(size)} {html.escape(name)}")
+    return "\n".join(lines), [path for path, _ in children if path != scan["path"]]
+
+def du_keyboard(user_id, scan, children):
+    """Create the disk usage keyboard, with cancel while running"""
+    if scan["status"] == "running":
+        return types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text="⛔ Cancel", callback_data="du_cancel")]
+        ])
+    path = scan["path"]
+    keyboard_buttons = [
+        [types.InlineKeyboardButton(text=f"📊 {os.path.basename(child)[:20]}", callback_data=f"du_{path_token(user_id, child)}")
+         for child in children[i:i + 2]]
+        for i in range(0, min(len(children), 6), 2)
+    ]
+    keyboard_buttons.append([
+        types.InlineKeyboardButton(text="🔄 Rescan", callback_data=f"du_rescan_{path_token(user_id, path)}"),
+        types.InlineKeyboardButton(text="📁 Open", callback_data=f"dir_{path_token(user_id, path)}")
+    ])
+    if path != "/":
+        keyboard_buttons.append([
+            types.InlineKeyboardButton(text="⬆️ Up", callback_data=f"du_{path_token(user_id, os.path.dirname(path))}")
+        ])
+    keyboard_buttons.append([types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")])
+    return types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+async def run_du(message, user_id, path, force=False):
+    """Scan a tree in the background, editing message with progress"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    cached = du_cache.get(path)
+    # A directory mtime only covers its own entries, hence the age limit
+    if (not force and cached and cached["mtime_ns"] == mtime_ns
+            and time.monotonic() - cached["finished_at"] < DU_CACHE_MAX_AGE):
+        du_cache.move_to_end(path)
+        scan = dict(cached, status="cached")
+        text, children = render_du(scan)
+        await message.edit_text(text, reply_markup=du_keyboard(user_id, scan, children))
+        return
+    
+    scan = {
+        "path": path, "mtime_ns": mtime_ns, "status": "running", "started": time.monotonic(),
+        "bytes": 0, "files": 0, "dirs": 0, "errors": 0, "children": Counter(), "biggest": [],
+        "lock": threading.Lock(), "cancel": threading.Event()
+    }
+    du_scans[user_id] = scan
+    loop = asyncio.get_running_loop()
+    walker = loop.run_in_executor(None, du_walk, scan)
+    try:
+        while True:
+            done, _ = await asyncio.wait({walker}, timeout=DU_PROGRESS_INTERVAL)
+            if done:
+                break
+            text, children = render_du(scan)
+            try:
+                await message.edit_text(text, reply_markup=du_keyboard(user_id, scan, children))
+            except Exception as e:
+                logging.error(f"Error updating disk usage progress: {e}")
+        await walker
+    finally:
+        if du_scans.get(user_id) is scan:
+            du_scans.pop(user_id)
+    
+    scan["finished_at"] = time.monotonic()
+    scan["elapsed"] = scan["finished_at"] - scan["started"]
+    scan["status"] = "cancelled" if scan["cancel"].is_set() else "done"
+    if scan["status"] == "done":
+        du_cache[path] = scan
+        du_cache.move_to_end(path)
+        while len(du_cache) > DU_CACHE_SIZE:
+            du_cache.popitem(last=False)
+    text, children = render_du(scan)
+    await message.edit_text(text, reply_markup=du_keyboard(user_id, scan, children))
+
+@dp.callback_query(F.data.startswith("du_"))
+async def disk_usage_handler(callback: types.CallbackQuery):
+    """Start, rescan or cancel a disk usage scan"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    user_id = callback.from_user.id
+    action = callback.data[3:]
+    if action == "cancel":
+        scan = du_scans.get(user_id)
+        if scan:
+            scan["cancel"].set()
+        await callback.answer("⛔ Cancelling..." if scan else "No scan running")
+        return
+    
+    force = action.startswith("rescan_")
+    path = await callback_path(callback, "du_rescan_" if force else "du_")
+    if path is None:
+        return
+    if user_id in du_scans:
+        await callback.answer("⏳ A scan is already running")
+        return
+    
+    await log_action(user_id, "disk_usage", path)
+    try:
+        await run_du(callback.message, user_id, path, force)
+    except Exception as e:
+        logging.error(f"Error in disk_usage_handler: {e}")
+        await callback.message.edit_text(f"❌ Error: {str(e)}", reply_markup=back_to_main_button())
+
 @dp.callback_query(F.data == "terminal")
 async def terminal_handler(callback: types.CallbackQuery):
     """Terminal menu"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     user_states[callback.from_user.id] = {"mode": "terminal"}
@@ -1000,6 +3829,8 @@ async def terminal_handler(callback: types.CallbackQuery):
         [types.InlineKeyboardButton(text="📊 System Status", callback_data="cmd_status")],
         [types.InlineKeyboardButton(text="📁 List Files", callback_data="cmd_ls")],
         [types.InlineKeyboardButton(text="🔧 Custom Command", callback_data="cmd_custom")],
+        [types.InlineKeyboardButton(text="🧵 Background Job", callback_data="cmd_background")],
+        [types.InlineKeyboardButton(text="📋 Jobs", callback_data="jobs")],
         [types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")]
     ])
     
@@ -1008,16 +3839,131 @@ async def terminal_handler(callback: types.CallbackQuery):
         reply_markup=keyboard
     )
 
+@dp.callback_query(F.data.startswith("exec_cancel_"))
+async def exec_cancel_handler(callback: types.CallbackQuery):
+    """Cancel a queued or running command"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    if cancel_exec_job(int(callback.data[12:]), callback.from_user.id):
+        await callback.answer("⛔ Cancelling...")
+    else:
+        await callback.answer("❌ Command already finished")
+
+@dp.message(Command("jobs"))
+async def jobs_command(message: types.Message):
+    """Show background jobs"""
+    if not await is_authorized(message.from_user.id):
+        return
+    
+    await log_action(message.from_user.id, "jobs_command")
+    text, keyboard = await render_jobs_list(message.from_user.id)
+    await message.answer(text, reply_markup=keyboard)
+
+async def render_jobs_list(user_id):
+    """Render background job list of user"""
+    rows = await db_fetchall(
+        "SELECT id, command, status, returncode, created_at, finished_at FROM bg_jobs "
+        "WHERE user_id = ? ORDER BY id DESC LIMIT 10",
+        (user_id,)
+    )
+    keyboard_buttons = []
+    if not rows:
+        text = "📭 <b>No background jobs</b>"
+    else:
+        text = "<b>🧵 Background Jobs</b>\n━━━━━━━━━━━━━━━━━━━━━━\n"
+        for job_id, command, status, returncode, created_at, finished_at in rows:
+            duration = seconds_to_human(int((finished_at or time.time()) - created_at))
+            text += f"{BG_JOB_ICONS.get(status, '❔')} <b>#{job_id}</b> {status} ({duration})\n"
+            text += f"└─ <code>{html.escape(command[:60])}</code>\n"
+            keyboard_buttons.append([
+                types.InlineKeyboardButton(text=f"#{job_id} {command[:30]}", callback_data=f"job_{job_id}")
+            ])
+    keyboard_buttons.append([types.InlineKeyboardButton(text="🔄 Refresh", callback_data="jobs")])
+    keyboard_buttons.append([types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")])
+    return text, types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+@dp.callback_query(F.data == "jobs")
+async def jobs_handler(callback: types.CallbackQuery):
+    """Show background jobs"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    text, keyboard = await render_jobs_list(callback.from_user.id)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("job_"))
+async def job_handler(callback: types.CallbackQuery):
+    """Show, tail, cancel, fetch or delete a background job"""
+    if not await is_authorized(callback.from_user.id):
+        return
+    
+    action, _, job_id = callback.data[4:].rpartition("_")
+    job_id = int(job_id)
+    row = await db_fetchone(
+        "SELECT command, status, returncode, output_path, created_at, finished_at FROM bg_jobs WHERE id = ? AND user_id = ?",
+        (job_id, callback.from_user.id)
+    )
+    if not row:
+        await callback.answer("❌ Job not found")
+        return
+    command, status, returncode, output_path, created_at, finished_at = row
+    output_size = os.path.getsize(output_path) if output_path and os.path.exists(output_path) else 0
+    
+    if action == "cancel":
+        if await cancel_bg_job(job_id, callback.from_user.id):
+            await callback.answer("⛔ Cancelling...")
+        else:
+            await callback.answer("❌ Job is not running")
+        return
+    if action == "output":
+        if not output_size:
+            await callback.answer("📭 Output is empty")
+            return
+        await deliver_file(callback.from_user.id, output_path, f"job_{job_id}.log", f"🧵 Job #{job_id}: {command[:100]}")
+        await callback.answer("✅ Output sent")
+        return
+    if action == "delete":
+        if status in ("starting", "running"):
+            await callback.answer("❌ Cancel the job first")
+            return
+        await delete_bg_job(job_id, output_path)
+        text, keyboard = await render_jobs_list(callback.from_user.id)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        return
+    
+    tail = ""
+    if output_size:
+        loop = asyncio.get_running_loop()
+        tail = await loop.run_in_executor(None, read_file_tail, output_path, BG_JOB_TAIL)
+    duration = seconds_to_human(int((finished_at or time.time()) - created_at))
+    text = (
+        f"{BG_JOB_ICONS.get(status, '❔')} <b>Job #{job_id}</b>: {status}"
+        f"{f' (exit {returncode})' if returncode is not None else ''}\n"
+        f"<code>{html.escape(command[:200])}</code>\n"
+        f"⏱️ {duration} | 📄 {format_bytes(output_size)}\n"
+        f"<pre>{html.escape(tail)[-OUTPUT_MESSAGE_LIMIT:] or ' '}</pre>"
+    )
+    keyboard_buttons = [[types.InlineKeyboardButton(text="🔄 Refresh", callback_data=f"job_{job_id}")]]
+    if status == "running":
+        keyboard_buttons.append([types.InlineKeyboardButton(text="⛔ Cancel", callback_data=f"job_cancel_{job_id}")])
+    keyboard_buttons.append([types.InlineKeyboardButton(text="📥 Full Output", callback_data=f"job_output_{job_id}")])
+    if status not in ("starting", "running"):
+        keyboard_buttons.append([types.InlineKeyboardButton(text="🗑️ Delete", callback_data=f"job_delete_{job_id}")])
+    keyboard_buttons.append([types.InlineKeyboardButton(text="🔙 Jobs", callback_data="jobs")])
+    await callback.message.edit_text(text, reply_markup=types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons))
+
 @dp.callback_query(F.data.startswith("cmd_"))
 async def execute_predefined(callback: types.CallbackQuery):
     """Execute predefined commands"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     commands = {
         "cmd_status": "top -bn1 | head -20",
         "cmd_ls": "ls -la ~",
-        "cmd_custom": "custom"
+        "cmd_custom": "custom",
+        "cmd_background": "background"
     }
     
     cmd = commands.get(callback.data)
@@ -1035,30 +3981,34 @@ async def execute_predefined(callback: types.CallbackQuery):
         user_states[callback.from_user.id] = {"mode": "wait_command"}
         return
     
-    await execute_command(callback.message, cmd)
+    if cmd == "background":
+        await callback.message.edit_text(
+            "🧵 <b>Enter command to run in background:</b>\n\n"
+            "Output is saved to disk and can be viewed from 📋 Jobs, even after a restart.\n"
+            "<i>Sudo commands are not supported in background mode.</i>"
+        )
+        user_states[callback.from_user.id] = {"mode": "wait_bg_command"}
+        return
+    
+    priority = EXEC_PRIORITY_HIGH if callback.data == "cmd_status" else EXEC_PRIORITY_NORMAL
+    await execute_command(callback.message, cmd, user_id=callback.from_user.id, priority=priority)
 
-async def execute_command(message: types.Message, cmd_text=None):
+async def execute_command(message: types.Message, cmd_text=None, user_id=None, priority=EXEC_PRIORITY_NORMAL):
     """Execute a shell command"""
-    if not is_authorized(message.from_user.id):
+    # Callback messages are sent by the bot, so callers pass the real user
+    user_id = user_id or message.from_user.id
+    if not await is_authorized(user_id):
         return
     
     cmd = cmd_text or message.text
     
-    log_action(message.from_user.id, "execute_command", cmd)
+    await log_action(user_id, "execute_command", cmd)
     
-    if not is_command_allowed(cmd):
-        await message.answer(f"🚫 Command <code>{cmd}</code> blocked by admin")
+    block_reason = await command_block_reason(cmd)
+    if block_reason:
+        await message.answer(block_reason)
         return
     
-    # Check for dangerous commands
-    dangerous_commands = ["rm -rf /", "dd if=", ":(){:|:&};:", "mkfs", "fdisk", "shutdown"]
-    for dangerous in dangerous_commands:
-        if dangerous in cmd.lower():
-            await message.answer(f"🚫 Command blocked for security: {dangerous}")
-            return
-    
-    user_id = message.from_user.id
-    
     # Check sudo attempts
     if user_id in sudo_attempts:
         attempts, timestamp = sudo_attempts[user_id]
@@ -1074,15 +4024,24 @@ async def execute_command(message: types.Message, cmd_text=None):
             timestamp = sudo_passwords[user_id]["timestamp"]
             
             if datetime.now().timestamp() - timestamp < 300:
-                await message.answer("⏳ <i>Using saved sudo password...</i>")
-                output, error = await execute_with_sudo(cmd, password)
+                status = await message.answer("⏳ <i>Using saved sudo password...</i>")
+                result, job = await run_scheduled(
+                    user_id, cmd, status,
+                    lambda reply_markup: execute_with_sudo(cmd, password, status, reply_markup),
+                    priority
+                )
+                if result is None:
+                    await status.edit_text("⛔ Command cancelled")
+                    return
                 
-                if output is None:
+                spool, error = result
+                if spool is None:
                     del sudo_passwords[user_id]
-                    await message.answer(error)
+                    await status.edit_text(error)
                     return
                 else:
-                    await send_command_output(message, cmd, output, error)
+                    spool["timing"] = format_job_timing(job)
+                    await send_command_output(message, cmd, spool, status)
                     return
             else:
                 del sudo_passwords[user_id]
@@ -1093,45 +4052,72 @@ async def execute_command(message: types.Message, cmd_text=None):
     
     # Execute regular command
     try:
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True
-        )
+        status = await message.answer(f"<b>Command:</b> <code>{html.escape(cmd[:200])}</code>\n⏳ <i>Starting...</i>")
         
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=30)
-        output = stdout.decode('utf-8', errors='ignore') or stderr.decode('utf-8', errors='ignore')
+        async def start(reply_markup):
+            process = await asyncio.create_subprocess_shell(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                start_new_session=True
+            )
+            return await stream_process(process, status, cmd, timeout=30, reply_markup=reply_markup)
         
-        await send_command_output(message, cmd, output, "")
+        spool, job = await run_scheduled(user_id, cmd, status, start, priority)
+        if spool is None:
+            await status.edit_text(f"<b>Command:</b> <code>{html.escape(cmd[:200])}</code>\n⛔ Cancelled")
+        else:
+            spool["timing"] = format_job_timing(job)
+            await send_command_output(message, cmd, spool, status)
         
-    except asyncio.TimeoutError:
-        await message.answer("⏱️ Command timeout (30 sec)")
     except Exception as e:
         await message.answer(f"❌ Error: {str(e)}")
     
     await start_handler(message)
 
-async def send_command_output(message, cmd, output, error):
-    """Send command output to user"""
-    combined_output = output + (error if error else "")
-    
-    if not combined_output.strip():
-        combined_output = "✅ Command executed, output empty"
-    
-    # If output too large, send as file
-    if len(combined_output) > 4000:
-        with open("/tmp/bot_output.txt", "w") as f:
-            f.write(combined_output)
-        await message.answer_document(FSInputFile("/tmp/bot_output.txt"), caption=f"Command output: {cmd[:100]}")
-        os.remove("/tmp/bot_output.txt")
-    else:
-        await message.answer(f"<b>Command:</b> <code>{cmd}</code>\n<b>Output:</b>\n<pre>{combined_output[:3500]}</pre>")
+async def send_command_output(message, cmd, spool, status=None):
+    """Send final command output to user and release the spool"""
+    try:
+        if spool["timed_out"]:
+            status_line = "⏱️ <b>Command timeout</b>, partial output:"
+        elif spool["returncode"]:
+            status_line = f"⚠️ <b>Exit code {spool['returncode']}</b>"
+        else:
+            status_line = "<b>Output:</b>"
+        if spool["timing"]:
+            status_line = f"{spool['timing']}\n{status_line}"
+        
+        # Small output fits into the status message
+        text = spool_text(spool) if spool["file"] is None and spool["size"] <= OUTPUT_MESSAGE_LIMIT else None
+        if text is not None and len(html.escape(text)) <= OUTPUT_MESSAGE_LIMIT:
+            if not text.strip():
+                text = "✅ Command executed, output empty"
+            final = f"<b>Command:</b> <code>{html.escape(cmd[:200])}</code>\n{status_line}\n<pre>{html.escape(text)}</pre>"
+            if status:
+                await status.edit_text(final)
+            else:
+                await message.answer(final)
+            return
+        
+        # If output too large, send as file
+        if spool["file"] is None:
+            fd, spool["path"] = tempfile.mkstemp(prefix="bot_output_", suffix=".txt")
+            spool["file"] = os.fdopen(fd, "wb")
+            spool["file"].writelines(spool["buffer"])
+            spool["buffer"] = []
+        spool["file"].close()
+        spool["file"] = None
+        await deliver_file(message.chat.id, spool["path"], "output.txt",
+                           f"Command output ({format_bytes(spool['size'])}): {cmd[:100]}")
+        if status:
+            await status.edit_text(render_live_output(cmd, spool, f"{status_line} <i>full output sent as file</i>"))
+    finally:
+        spool_cleanup(spool)
 
 @dp.message()
 async def handle_messages(message: types.Message):
     """Handle all text messages from users"""
-    if not is_authorized(message.from_user.id):
+    if not await is_authorized(message.from_user.id):
         return
     
     user_id = message.from_user.id
@@ -1141,37 +4127,64 @@ async def handle_messages(message: types.Message):
         user_states[user_id] = {}
         await execute_command(message)
     
+    elif user_state.get("mode") == "wait_bg_command":
+        user_states[user_id] = {}
+        cmd = message.text.strip()
+        await log_action(user_id, "start_bg_job", cmd)
+        block_reason = await command_block_reason(cmd)
+        if block_reason:
+            await message.answer(block_reason)
+        elif cmd.startswith("sudo "):
+            await message.answer("🚫 Sudo commands can't run as background jobs")
+        else:
+            try:
+                job_id = await start_bg_job(user_id, cmd)
+                keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                    [types.InlineKeyboardButton(text="👁️ View Job", callback_data=f"job_{job_id}")],
+                    [types.InlineKeyboardButton(text="📋 Jobs", callback_data="jobs")]
+                ])
+                await message.answer(f"🧵 Job <b>#{job_id}</b> started", reply_markup=keyboard)
+            except Exception as e:
+                await message.answer(f"❌ Error: {str(e)}")
+    
     elif user_state.get("mode") == "wait_sudo_password":
         sudo_command = user_state.get("sudo_command", "")
         password = message.text
         
-        await message.answer("⏳ <i>Executing sudo command...</i>")
+        status = await message.answer("⏳ <i>Executing sudo command...</i>")
         
-        output, error = await execute_with_sudo(sudo_command, password)
-        
-        if output is None:
-            # Wrong password
-            if user_id not in sudo_attempts:
-                sudo_attempts[user_id] = [1, datetime.now().timestamp()]
-            else:
-                attempts, _ = sudo_attempts[user_id]
-                sudo_attempts[user_id] = [attempts + 1, datetime.now().timestamp()]
-            
-            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")]
-            ])
-            await message.answer(f"{error}", reply_markup=keyboard)
+        result, job = await run_scheduled(
+            user_id, sudo_command, status,
+            lambda reply_markup: execute_with_sudo(sudo_command, password, status, reply_markup)
+        )
+        if result is None:
+            await status.edit_text("⛔ Command cancelled")
         else:
-            # Correct password - save for 5 minutes
-            sudo_passwords[user_id] = {
-                "password": password,
-                "timestamp": datetime.now().timestamp()
-            }
-            
-            if user_id in sudo_attempts:
-                del sudo_attempts[user_id]
-            
-            await send_command_output(message, sudo_command, output, error)
+            spool, error = result
+            if spool is None:
+                # Wrong password
+                if user_id not in sudo_attempts:
+                    sudo_attempts[user_id] = [1, datetime.now().timestamp()]
+                else:
+                    attempts, _ = sudo_attempts[user_id]
+                    sudo_attempts[user_id] = [attempts + 1, datetime.now().timestamp()]
+                
+                keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                    [types.InlineKeyboardButton(text="🔙 Main Menu", callback_data="main_menu")]
+                ])
+                await message.answer(f"{error}", reply_markup=keyboard)
+            else:
+                # Correct password - save for 5 minutes
+                sudo_passwords[user_id] = {
+                    "password": password,
+                    "timestamp": datetime.now().timestamp()
+                }
+                
+                if user_id in sudo_attempts:
+                    del sudo_attempts[user_id]
+                
+                spool["timing"] = format_job_timing(job)
+                await send_command_output(message, sudo_command, spool, status)
         
         user_states[user_id] = {}
         await start_handler(message)
@@ -1184,16 +4197,13 @@ async def handle_messages(message: types.Message):
                 target_user_id = int(parts[0])
                 reason = parts[1] if len(parts) > 1 else "Administrator"
                 
-                conn = sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute(
+                await db_execute(
                     "INSERT OR REPLACE INTO blocked_users (user_id, reason) VALUES (?, ?)",
                     (target_user_id, reason)
                 )
-                conn.commit()
-                conn.close()
+                await reload_auth_cache()
                 
-                log_action(user_id, "block_user", f"target: {target_user_id}, reason: {reason}")
+                await log_action(user_id, "block_user", f"target: {target_user_id}, reason: {reason}")
                 await message.answer(f"✅ User {target_user_id} blocked. Reason: {reason}")
             except ValueError:
                 await message.answer("❌ Invalid user ID format")
@@ -1206,13 +4216,10 @@ async def handle_messages(message: types.Message):
         try:
             target_user_id = int(message.text)
             
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM blocked_users WHERE user_id = ?", (target_user_id,))
-            conn.commit()
-            conn.close()
+            await db_execute("DELETE FROM blocked_users WHERE user_id = ?", (target_user_id,))
+            await reload_auth_cache()
             
-            log_action(user_id, "unblock_user", f"target: {target_user_id}")
+            await log_action(user_id, "unblock_user", f"target: {target_user_id}")
             await message.answer(f"✅ User {target_user_id} unblocked")
         except ValueError:
             await message.answer("❌ Invalid user ID format")
@@ -1224,37 +4231,63 @@ async def handle_messages(message: types.Message):
     elif user_state.get("mode") == "wait_add_command":
         command = message.text.strip()
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute(
+            await db_execute(
                 "INSERT OR REPLACE INTO allowed_commands (command, allowed) VALUES (?, ?)",
                 (command, 1)
             )
-            conn.commit()
-            conn.close()
             
-            log_action(user_id, "add_command", command)
+            await reload_command_policy()
+            await log_action(user_id, "add_command", command)
             await message.answer(f"✅ Command <code>{command}</code> added")
         except Exception as e:
             await message.answer(f"❌ Error adding command: {str(e)}")
         user_states[user_id] = {}
         await admin_command(message)
     
+    elif user_state.get("mode") == "wait_file_filter":
+        path = user_state["path"]
+        user_states[user_id] = {"path": path}
+        view = file_browser_views.setdefault(user_id, {"path": path, "sort": "name", "filter": "", "page": 0})
+        view.update(path=path, filter=message.text.strip().lower(), first=None)
+        try:
+            text, keyboard = await render_directory(user_id, path)
+            await message.answer(text, reply_markup=keyboard)
+        except Exception as e:
+            await message.answer(f"❌ Error: {e}", reply_markup=back_to_main_button())
+    
+    elif user_state.get("mode") == "wait_logs_filter":
+        user_states[user_id] = {}
+        try:
+            filters = parse_log_filters(message.text)
+            filters.pop("format", None)
+            log_browser_filters[user_id] = filters
+            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text="📝 View Logs", callback_data="admin_logs")]
+            ])
+            await message.answer(f"🔎 Filter set: {describe_log_filters(filters) or 'none'}", reply_markup=keyboard)
+        except ValueError as e:
+            await message.answer(f"❌ Invalid filter: {str(e)}")
+            await admin_command(message)
+    
+    elif user_state.get("mode") == "wait_export_filter":
+        try:
+            filters = parse_log_filters(message.text)
+            await message.answer("⏳ <i>Exporting logs...</i>")
+            await send_log_export(message.chat.id, filters.get("format", "csv"), filters)
+        except ValueError as e:
+            await message.answer(f"❌ Invalid filter: {str(e)}")
+        except Exception as e:
+            await message.answer(f"❌ Error exporting logs: {str(e)}")
+        user_states[user_id] = {}
+        await admin_command(message)
+    
     elif user_state.get("mode") == "wait_disable_command":
         command = message.text.strip()
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("UPDATE allowed_commands SET allowed = 0 WHERE command = ?", (command,))
-            if cursor.rowcount == 0:
-                cursor.execute(
-                    "INSERT INTO allowed_commands (command, allowed) VALUES (?, ?)",
-                    (command, 0)
-                )
-            conn.commit()
-            conn.close()
+            await db_call(set_command_allowed, command, 0)
             
-            log_action(user_id, "disable_command", command)
+            await reload_command_policy()
+            await log_action(user_id, "disable_command", command)
             await message.answer(f"🚫 Command <code>{command}</code> disabled")
         except Exception as e:
             await message.answer(f"❌ Error disabling command: {str(e)}")
@@ -1264,18 +4297,10 @@ async def handle_messages(message: types.Message):
     elif user_state.get("mode") == "wait_enable_command":
         command = message.text.strip()
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("UPDATE allowed_commands SET allowed = 1 WHERE command = ?", (command,))
-            if cursor.rowcount == 0:
-                cursor.execute(
-                    "INSERT INTO allowed_commands (command, allowed) VALUES (?, ?)",
-                    (command, 1)
-                )
-            conn.commit()
-            conn.close()
+            await db_call(set_command_allowed, command, 1)
             
-            log_action(user_id, "enable_command", command)
+            await reload_command_policy()
+            await log_action(user_id, "enable_command", command)
             await message.answer(f"✅ Command <code>{command}</code> enabled")
         except Exception as e:
             await message.answer(f"❌ Error enabling command: {str(e)}")
@@ -1285,13 +4310,10 @@ async def handle_messages(message: types.Message):
     elif user_state.get("mode") == "wait_remove_command":
         command = message.text.strip()
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM allowed_commands WHERE command = ?", (command,))
-            conn.commit()
-            conn.close()
+            await db_execute("DELETE FROM allowed_commands WHERE command = ?", (command,))
             
-            log_action(user_id, "remove_command", command)
+            await reload_command_policy()
+            await log_action(user_id, "remove_command", command)
             await message.answer(f"🗑️ Command <code>{command}</code> removed from database")
         except Exception as e:
             await message.answer(f"❌ Error removing command: {str(e)}")
@@ -1304,7 +4326,7 @@ async def handle_messages(message: types.Message):
 @dp.callback_query(F.data == "utils")
 async def utils_handler(callback: types.CallbackQuery):
     """Utilities menu"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -1319,7 +4341,7 @@ async def utils_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("util_"))
 async def execute_util(callback: types.CallbackQuery):
     """Execute utility command"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     utils = {
@@ -1341,7 +4363,7 @@ async def execute_util(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("confirm_"))
 async def confirm_util(callback: types.CallbackQuery):
     """Confirm utility execution"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     command = callback.data[8:]
@@ -1350,12 +4372,12 @@ async def confirm_util(callback: types.CallbackQuery):
         await callback.message.edit_text("🔐 <b>Sudo password required</b>\nEnter password to execute command:")
         user_states[callback.from_user.id] = {"mode": "wait_sudo_password", "sudo_command": command}
     else:
-        await execute_command(callback.message, command)
+        await execute_command(callback.message, command, user_id=callback.from_user.id)
 
 @dp.callback_query(F.data == "main_menu")
 async def main_menu_handler(callback: types.CallbackQuery):
     """Return to main menu"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     user_id = callback.from_user.id
@@ -1377,7 +4399,7 @@ async def main_menu_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_menu")
 async def admin_menu_handler(callback: types.CallbackQuery):
     """Return to admin menu"""
-    if not is_authorized(callback.from_user.id):
+    if not await is_authorized(callback.from_user.id):
         return
     
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -1404,7 +4426,18 @@ def back_to_admin_button():
 
 async def main():
     """Main bot entry point"""
-    await dp.start_polling(bot)
+    await recover_bg_jobs()
+    writer = asyncio.create_task(log_writer())
+    sampler = asyncio.create_task(metrics_sampler())
+    retention = asyncio.create_task(log_retention())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        retention.cancel()
+        sampler.cancel()
+        writer.cancel()
+        await flush_logs()
+        close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
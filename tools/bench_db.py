@@ -0,0 +1,144 @@
+"""Handler latency benchmark for the SQLite access layer
+
+Floods an event loop with simulated updates, each doing the database work of
+a handler: log_action, is_authorized and is_command_allowed. Compares the old
+per-call sqlite3.connect on the event loop with one persistent WAL connection
+served by a single database thread, as host.py does with db_call.
+
+    python tools/bench_db.py --updates 3000 --rate 500
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEMA = [
+    "CREATE TABLE allowed_commands (id INTEGER PRIMARY KEY AUTOINCREMENT, command TEXT NOT NULL, "
+    "allowed INTEGER DEFAULT 1, added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+    "CREATE TABLE blocked_users (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL UNIQUE, "
+    "reason TEXT, blocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+    "CREATE TABLE bot_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT, "
+    "details TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+    "INSERT INTO allowed_commands (command, allowed) VALUES ('rm', 0), ('ls', 1)",
+    "INSERT INTO blocked_users (user_id) VALUES (13)"
+]
+
+def create_db(path):
+    """Create a database with the original bot tables"""
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+
+def per_call_handler(path, user_id):
+    """Database work of one update with a connection per query (old code)"""
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO bot_logs (user_id, action, details) VALUES (?, ?, ?)", (user_id, "message", "ls -la"))
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(path)
+    conn.execute("SELECT user_id FROM blocked_users WHERE user_id = ?", (user_id,)).fetchone()
+    conn.close()
+    conn = sqlite3.connect(path)
+    conn.execute("SELECT allowed FROM allowed_commands WHERE command = ?", ("ls",)).fetchone()
+    conn.close()
+
+def make_layer(path):
+    """Open a persistent WAL connection and return (db_call, close) like host.py"""
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bench_db")
+    conn = executor.submit(sqlite3.connect, path, check_same_thread=False, cached_statements=256).result()
+    for pragma in ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL", "PRAGMA busy_timeout=5000"):
+        executor.submit(conn.execute, pragma).result()
+
+    def task(func, args):
+        result = func(conn, *args)
+        conn.commit()
+        return result
+
+    async def db_call(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, task, func, args)
+
+    def close():
+        executor.submit(conn.close).result()
+        executor.shutdown()
+    return db_call, close
+
+async def layer_handler(db_call, user_id):
+    """Database work of one update through the persistent layer"""
+    await db_call(lambda conn: conn.execute(
+        "INSERT INTO bot_logs (user_id, action, details) VALUES (?, ?, ?)", (user_id, "message", "ls -la")
+    ))
+    await db_call(lambda conn: conn.execute("SELECT user_id FROM blocked_users WHERE user_id = ?", (user_id,)).fetchone())
+    await db_call(lambda conn: conn.execute("SELECT allowed FROM allowed_commands WHERE command = ?", ("ls",)).fetchone())
+
+async def flood(handler, updates, rate):
+    """Feed updates to handler at rate per second, returns (latencies, max loop lag, elapsed)
+
+    Latency is measured from the moment an update arrives, so time spent
+    waiting behind a blocked event loop is included.
+    """
+    latencies = []
+    lag = {"max": 0.0}
+
+    async def update(user_id, arrived):
+        await handler(user_id)
+        latencies.append(time.perf_counter() - arrived)
+
+    async def ticker():
+        # How late a 1 ms timer fires shows how long the loop was blocked
+        while True:
+            expected = time.perf_counter() + 0.001
+            await asyncio.sleep(0.001)
+            lag["max"] = max(lag["max"], time.perf_counter() - expected)
+
+    probe = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    tasks = []
+    for n in range(updates):
+        arrived = started + n / rate
+        delay = arrived - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(update(n % 100, arrived)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    probe.cancel()
+    return latencies, lag["max"], elapsed
+
+def report(name, latencies, lag, elapsed):
+    """Print latency percentiles of one run"""
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:10} {len(latencies) / elapsed:8.0f} upd/s  p50 {statistics.median(latencies) * 1000:7.2f} ms  "
+          f"p99 {p99 * 1000:7.2f} ms  max loop lag {lag * 1000:7.2f} ms")
+
+async def run(updates, rate, directory):
+    """Benchmark both access patterns on fresh databases"""
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        path = os.path.join(tmp, "before.db")
+        create_db(path)
+
+        async def before(user_id):
+            per_call_handler(path, user_id)
+        report("per-call", *await flood(before, updates, rate))
+
+        path = os.path.join(tmp, "after.db")
+        create_db(path)
+        db_call, close = make_layer(path)
+        try:
+            report("db_call", *await flood(lambda user_id: layer_handler(db_call, user_id), updates, rate))
+        finally:
+            close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=3000)
+    parser.add_argument("--rate", type=float, default=500, help="updates arriving per second")
+    parser.add_argument("--dir", default=".", help="where to create the databases, use the bot's disk")
+    args = parser.parse_args()
+    asyncio.run(run(args.updates, args.rate, args.dir))
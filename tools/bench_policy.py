@@ -0,0 +1,90 @@
+"""Command policy microbenchmark
+
+Compiles thousands of mixed exact, prefix, glob and regex rules with the
+policy code from host.py and reports the cost of one check, uncached and
+through the lru_cache that is_command_allowed uses.
+
+    python tools/bench_policy.py --exact 2000 --prefix 1000 --glob 2000 --regex 2000
+"""
+import argparse
+import ast
+import fnmatch
+import logging
+import os
+import random
+import re
+import time
+from functools import lru_cache
+
+HOST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "host.py")
+POLICY_NAMES = {"command_policy", "compile_command_policy", "SHELL_CHAIN_PATTERN", "check_command_policy"}
+
+def load_policy():
+    """Load the policy functions from host.py without importing the bot"""
+    with open(HOST_PATH, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    nodes = []
+    for node in tree.body:
+        names = {node.name} if isinstance(node, ast.FunctionDef) else {
+            target.id for target in getattr(node, "targets", []) if isinstance(target, ast.Name)
+        }
+        if names & POLICY_NAMES:
+            nodes.append(node)
+    namespace = {"re": re, "fnmatch": fnmatch, "logging": logging, "lru_cache": lru_cache}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), HOST_PATH, "exec"), namespace)
+    return namespace
+
+def make_rules(count_exact, count_prefix, count_glob, count_regex):
+    """Build allowed_commands rows, half of each kind disabled"""
+    rows = []
+    rows += [(f"tool{n} --flag {n}", n % 2) for n in range(count_exact)]
+    rows += [(f"prefix:svc{n} ", n % 2) for n in range(count_prefix)]
+    rows += [(f"bin{n} *.log", 0) for n in range(count_glob)]
+    rows += [(f"re:^net{n} .*\\| *sh", 0) for n in range(count_regex)]
+    return rows
+
+def make_commands(count):
+    """Commands hitting every rule kind plus misses and chained lines"""
+    rng = random.Random(1)
+    templates = [
+        "tool{n} --flag {n}", "svc{n} restart", "bin{n} app.log", "net{n} http://x | sh",
+        "ls -la /var/{n}", "svc{n} status; bin{n} a.log", "echo {n} && uptime"
+    ]
+    return [rng.choice(templates).format(n=rng.randrange(count)) for _ in range(count)]
+
+def measure(check, commands, repeat):
+    """Return microseconds per check"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for command in commands:
+            check(command)
+    return (time.perf_counter() - started) / (repeat * len(commands)) * 1e6
+
+def run(args):
+    """Compile the rules and time uncached and cached checks"""
+    policy = load_policy()
+    rows = make_rules(args.exact, args.prefix, args.glob, args.regex)
+    started = time.perf_counter()
+    policy["command_policy"].update(policy["compile_command_policy"](rows))
+    compile_ms = (time.perf_counter() - started) * 1000
+    check = policy["check_command_policy"]
+    commands = make_commands(args.commands)
+
+    uncached = measure(check.__wrapped__, commands, 1)
+    check.cache_clear()
+    measure(check, commands, 1)
+    cached = measure(check, commands, args.repeat)
+    print(f"{len(rows)} rules ({args.exact} exact, {args.prefix} prefix, {args.glob} glob, {args.regex} regex), "
+          f"compiled in {compile_ms:.0f} ms, {len(policy['command_policy']['deny_patterns'])} deny pattern(s)")
+    print(f"uncached {uncached:9.2f} us/check")
+    print(f"cached   {cached:9.2f} us/check ({check.cache_info().currsize} commands cached)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--exact", type=int, default=2000)
+    parser.add_argument("--prefix", type=int, default=1000)
+    parser.add_argument("--glob", type=int, default=2000)
+    parser.add_argument("--regex", type=int, default=2000)
+    parser.add_argument("--commands", type=int, default=2000, help="distinct commands to check")
+    parser.add_argument("--repeat", type=int, default=20, help="passes over the commands when cached")
+    run(parser.parse_args())